@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Batched version of the packaging algorithm in packageRouter.py.
+
+getObj() routes the packages of every (start, goal) pair on its own copy of
+the liquidities, one scalar router() call at a time. Here the liquidities of
+all pairs are one array of shape (pairs, edges, 2) and the packages of all
+pairs are routed in lockstep:
+
+    1. every pair puts a package of its trade size on its start token
+    2. the amounts arriving at the tokens are relaxed over all edges of all
+       pairs at once with the CPMM formula 1/(x/y * 1/(1-fee) * 1/dx + 1/y),
+       again skipping profitable trades. As the amount shrinks along every
+       edge used, n-1 rounds reach the same amounts as the Dijkstra logic.
+    3. the path to the goal of every pair is followed back through the
+       predecessor edges and the liquidities are updated as in router().
+
+The arrived amounts are the same as the ones of getObj() up to rounding.
+
+"""
+
+import numpy as np
+import itertools
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m, 2) with the liquidity levels [x, y] of every edge of
+        the graph, or an array (blocks, m, 2) with one configuration per block
+    starts, goals: token ids of the start and goal of every block
+    tradesizes: size of the packages of every block
+    splitInto: number of packages routed per block
+    fee: fee for the CPMM
+
+OUTPUT:
+    arrived: array (blocks,) with the amount received by every block
+    state: array (blocks, m, 2) with the liquidities after routing
+'''
+def routeBatch(graph, liquidity, starts, goals, tradesizes, splitInto, fee=0.003):
+    n = graph.n
+    blocks = len(starts)
+    rows = np.arange(blocks)
+
+    source = graph.source
+    target = graph.target
+    reverse = graph.reverse
+    # position of every edge in a (n, n) matrix of its source and target
+    cell = source * n + target
+
+    state = np.array(np.broadcast_to(liquidity, (blocks, graph.m, 2)), dtype=float)
+    arrived = np.zeros(blocks)
+
+    for package in range(splitInto):
+        tradeFromStart = np.zeros((blocks, n))
+        tradeFromStart[rows, starts] = tradesizes
+        previous = np.full((blocks, n), -1)
+
+        for round in range(n - 1):
+            x = state[:, :, 0]
+            y = state[:, :, 1]
+            dx = tradeFromStart[:, source]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dy = 1/(x/y * 1/(1-fee) * 1/dx + 1/y)
+
+            # no empty pools, no empty tokens and no profitable trades
+            dy = np.where((y != 0) & (dx != 0) & (dy < dx), dy, 0)
+
+            offers = np.zeros((blocks, n * n))
+            offers[:, cell] = dy
+            offers = offers.reshape(blocks, n, n)
+
+            bestSource = offers.argmax(axis=1)
+            best = np.take_along_axis(offers, bestSource[:, None, :], axis=1)[:, 0, :]
+
+            improved = best > tradeFromStart
+            if not improved.any():
+                break
+
+            tradeFromStart = np.where(improved, best, tradeFromStart)
+            previous = np.where(improved, graph.edgeMatrix[bestSource, np.arange(n)], previous)
+
+        # follow the paths back from the goals and update the liquidities
+        received = tradeFromStart[rows, goals]
+        active = received > 0
+        arrived += received
+
+        node = goals.copy()
+        for hop in range(n - 1):
+            active &= node != starts
+            if not active.any():
+                break
+
+            block = rows[active]
+            edge = previous[block, node[active]]
+            inserted = (1-fee) * tradeFromStart[block, source[edge]]
+            removed = tradeFromStart[block, target[edge]]
+
+            state[block, edge, 0] += inserted
+            state[block, edge, 1] -= removed
+            state[block, reverse[edge], 0] -= removed
+            state[block, reverse[edge], 1] += inserted
+
+            node[active] = source[edge]
+
+    return arrived, state
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m, 2) with the liquidity levels [x, y] of every edge
+    bucket: Determines the size of trades we are considering (see config)
+    splitInto: splitInto many uniform packages are routed sequentially
+    fee: fee for the CPMM
+
+OUTPUT:
+    objective: the average exchange rate between any pair scaled by demand
+    arrived: dictionary with the amount received for every (start, goal)
+    state: array (pairs, m, 2) with the liquidities after routing each pair
+'''
+def getObjBatched(graph, liquidity, bucket, splitInto, fee=0.003):
+    pairs = list(itertools.permutations(graph.nodes, 2))
+    starts = np.array([graph.tokenId[start] for start, goal in pairs])
+    goals = np.array([graph.tokenId[goal] for start, goal in pairs])
+
+    b = graph.bucketNames.index(bucket)
+    tradesizes = np.full(len(pairs), graph.tradesizes[b]/(splitInto*graph.totalLiquidity))
+
+    received, state = routeBatch(graph, liquidity, starts, goals, tradesizes, splitInto, fee)
+
+    objective = float(np.dot(graph.demand[starts, goals, b], received))
+    arrived = dict(zip(pairs, received.tolist()))
+
+    return objective, arrived, state
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m, 2) with the liquidity levels [x, y] of every edge
+    buckets: names of the buckets to compute the objective for
+    splitInto: splitInto many uniform packages are routed sequentially
+    fee: fee for the CPMM
+
+OUTPUT:
+    objectives: list with the objective of every bucket, the same as the ones
+        of getObjBatched(). The pairs of all buckets are routed in one batch.
+    received: array (buckets, pairs) with the amount received by every pair
+'''
+def getObjectives(graph, liquidity, buckets, splitInto, fee=0.003):
+    pairs = list(itertools.permutations(graph.nodes, 2))
+    starts = np.array([graph.tokenId[start] for start, goal in pairs])
+    goals = np.array([graph.tokenId[goal] for start, goal in pairs])
+    bucketIds = [graph.bucketNames.index(bucket) for bucket in buckets]
+
+    tradesizes = np.repeat(graph.tradesizes[bucketIds]/(splitInto*graph.totalLiquidity), len(pairs))
+    received, state = routeBatch(graph, liquidity, np.tile(starts, len(bucketIds)), np.tile(goals, len(bucketIds)), tradesizes, splitInto, fee)
+    received = received.reshape(len(bucketIds), len(pairs))
+
+    objectives = []
+    for i, b in enumerate(bucketIds):
+        objectives.append(float(np.dot(graph.demand[starts, goals, b], received[i])))
+
+    return objectives, received
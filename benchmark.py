@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the engines on synthetic instances over a grid of token counts.
+
+For every n in 'sizes' an instance is written with syntheticData.py into
+'directory'/n<n> and every engine in 'engines' is timed on it in a fresh
+process, started in the folder of the instance as the scripts expect:
+
+    getConfig               'ingest' reads the csv windows into weights and
+                            reserves as the main code of getConfig.py does,
+                            'ingest cached' the same from the columnar cache
+    packageRouter           'objective' one getObjAll() of the configuration,
+                            'descent move' one evaluateMove() of the descent
+                            (the value is the estimated time of a sweep)
+    dualRouter              'objective' dualRouter.getObjective()
+    convexCalculateTrade    'build' import and construction of the problem,
+    convexOptimizeTrade     'solve' the first solve, 'resolve' further solves
+
+Every phase is repeated 'repeats' times and the fastest run is kept, except
+for 'build' and 'solve' which only happen once per process.
+
+Every measurement is appended as one json line to 'resultFile' in
+'directory' with the commit, the instance and the phase, so the scaling
+curves of different versions can be compared:
+    {"commit": ..., "date": ..., "n": 6, "pools": 22, "engine": "dualRouter",
+     "phase": "objective", "seconds": 0.12, "value": 0.93, ...}
+
+"""
+
+import numpy as np
+import pandas as pd
+import pathlib
+import json
+import os
+import io
+import time
+import datetime
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+import concurrent.futures
+import importlib.metadata
+import syntheticData
+import graphModel
+
+
+
+# Numbers of tokens of the instances
+sizes = [3, 4, 6, 8]
+
+# Instance parameters (see syntheticData.py)
+density = 0.6
+reserves = 'lognormal'
+demand = 'zipf'
+buckets = 'thesis'
+seed = 0
+
+# Csv data for getConfig: number of windows, swaps and reserve updates per window
+windows = 3
+swaps = 100000
+updates = 20000
+
+engines = ['getConfig', 'packageRouter', 'dualRouter', 'convexCalculateTrade', 'convexOptimizeTrade']
+
+# Settings of the engines, set after their import, so only settings used
+# while solving have an effect. The objective cache of packageRouter would
+# answer the repeats without routing.
+engineSettings = {
+    'packageRouter': {'splitInto': 100, 'cacheSize': 0},
+    'convexCalculateTrade': {'strategy': 'production'},
+    'convexOptimizeTrade': {'strategy': 'production'}
+}
+
+# Number of runs of every phase, the fastest one is kept
+repeats = 3
+
+# Number of candidate moves of the descent timed per instance
+descentMoves = 10
+
+# Folder of the instances and file in it the results are appended to, the
+# folder is ignored by git
+directory = 'benchmarks'
+resultFile = pathlib.Path(directory, 'benchmark.jsonl')
+
+
+
+'''
+INPUT:
+    function: function without arguments to time
+    runs: number of runs
+
+OUTPUT:
+    seconds: wall-clock time of the fastest run
+    value: return value of the last run
+'''
+def timeIt(function, runs=1):
+    seconds = np.inf
+    for run in range(runs):
+        started = time.perf_counter()
+        value = function()
+        seconds = min(seconds, time.perf_counter() - started)
+
+    return seconds, value
+
+
+
+'''
+INPUT:
+    tokens: dictionary address -> symbol of the instance (see syntheticData.makeInstance)
+
+OUTPUT:
+    trades: number of trades counted by getConfig.py in the csv windows of
+        the current folder, which goes through the same steps as its main code
+'''
+def ingest(tokens):
+    # getConfig.py reads its data relative to the working directory and
+    # only defines paths on import
+    import getConfig
+    getConfig.tokenSlice = tokens
+
+    pools = pd.Index(list(getConfig.getPools()))
+    blocks = [syntheticData.firstBlock + w*syntheticData.step for w in range(windows)]
+
+    # only the events of the snapshot are kept, as without rolling configs in getConfig.py
+    snapshot = blocks[-1] + syntheticData.step - 1
+    snapshotBlocks = np.array([snapshot])
+
+    partials = []
+    events = []
+    for block in blocks:
+        partials.append(getConfig.getWeights(block, False))
+        events.append(getConfig.getReserveEvents(block, pools, snapshotBlocks))
+
+    reserveIndex = getConfig.buildReserveIndex(events, pools)
+    getConfig.getReservesAt(reserveIndex, snapshot)
+
+    demandCube = getConfig.buildDemandCube(blocks[0], syntheticData.step, partials)
+    getConfig.queryDemand(demandCube, blocks[0], blocks[-1] + syntheticData.step)
+
+    return int(demandCube['counts'][-1].sum())
+
+
+
+'''
+INPUT:
+    engine: name of the engine in 'engines'
+    instance: folder of the instance
+    tokens: dictionary address -> symbol of the instance
+
+OUTPUT:
+    results: list of dictionaries with the 'phase', 'seconds' and 'value' of
+        every measurement. Meant to run in a process of its own, as the
+        scripts load config.json from the working directory on import.
+'''
+def benchEngine(engine, instance, tokens):
+    os.chdir(instance)
+    results = []
+
+    # the engines print progress and warnings we don't want in the table
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine == 'getConfig':
+            import getConfig
+            getConfig.cacheWindows = False
+            seconds, trades = timeIt(lambda: ingest(tokens), repeats)
+            results.append({'phase': 'ingest', 'seconds': seconds, 'value': trades})
+
+            getConfig.cacheWindows = True
+            ingest(tokens)
+            seconds, trades = timeIt(lambda: ingest(tokens), repeats)
+            results.append({'phase': 'ingest cached', 'seconds': seconds, 'value': trades})
+
+        elif engine == 'packageRouter':
+            seconds, packageRouter = timeIt(lambda: __import__('packageRouter'))
+            results.append({'phase': 'build', 'seconds': seconds, 'value': None})
+            for key, value in engineSettings.get(engine, {}).items():
+                setattr(packageRouter, key, value)
+
+            liquidities = packageRouter.scaledLiquidity
+            seconds, (objectives, objective) = timeIt(lambda: packageRouter.getObjAll(liquidities, packageRouter.splitInto, packageRouter.fee, packageRouter.tolerance), repeats)
+            results.append({'phase': 'objective', 'seconds': seconds, 'value': objective})
+
+            moves = [(pool1, pool2) for pool1 in range(packageRouter.m) for pool2 in range(packageRouter.m) if pool1 != pool2 and liquidities[2*pool2]]
+            undo = []
+            started = time.perf_counter()
+            for pool1, pool2 in moves[:descentMoves]:
+                packageRouter.evaluateMove(liquidities, pool1, pool2, undo, packageRouter.tolerance)
+                packageRouter.rollback(liquidities, undo)
+            seconds = (time.perf_counter() - started)/max(1, min(descentMoves, len(moves)))
+            results.append({'phase': 'descent move', 'seconds': seconds, 'value': seconds*len(moves)})
+
+        elif engine == 'dualRouter':
+            import dualRouter
+            graph = graphModel.loadGraph('config.json', 4)
+            seconds, (objective, arrived) = timeIt(lambda: dualRouter.getObjective(graph, graph.liquidity), repeats)
+            results.append({'phase': 'objective', 'seconds': seconds, 'value': objective})
+
+        else:
+            seconds, script = timeIt(lambda: __import__(engine))
+            results.append({'phase': 'build', 'seconds': seconds, 'value': script.prob.size_metrics.num_scalar_variables})
+            for key, value in engineSettings.get(engine, {}).items():
+                setattr(script, key, value)
+
+            if engine == 'convexCalculateTrade':
+                solve = lambda: script.solveSnapshots([script.graph.liquidity])[0]
+            else:
+                solve = lambda: script.solverStrategy.solve(script.prob, script.strategy, script.timeBudget)[0]
+
+            seconds, objective = timeIt(solve)
+            results.append({'phase': 'solve', 'seconds': seconds, 'value': objective})
+            seconds, objective = timeIt(solve, repeats)
+            results.append({'phase': 'resolve', 'seconds': seconds, 'value': objective})
+
+    return results
+
+
+
+'''
+OUTPUT:
+    version: dictionary with the commit of the repository, whether it has
+        uncommitted changes, the date and the versions of Python and the
+        packages the engines use
+'''
+def getVersion():
+    root = pathlib.Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+        dirty = None
+
+    version = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version()
+    }
+    for package in ['numpy', 'scipy', 'pandas', 'cvxpy']:
+        try:
+            version[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            version[package] = None
+
+    return version
+
+
+
+if __name__ == '__main__':
+    """
+    START BENCHMARK
+
+    Every engine runs in a new process, so the modules load the config of
+    their instance and nothing is shared between the measurements.
+
+    """
+
+    version = getVersion()
+    context = multiprocessing.get_context('spawn')
+
+    print('n\tpools\tengine\t\t\tphase\t\tseconds\t\tvalue')
+    for n in sizes:
+        instance = pathlib.Path(directory, 'n' + str(n)).resolve()
+        tokens = syntheticData.makeInstance(instance, n, windows if 'getConfig' in engines else 0, swaps, updates,
+                                            density=density, reserves=reserves, demand=demand, buckets=buckets, seed=seed)
+        graph = graphModel.loadGraph(pathlib.Path(instance/'config.json'), 4)
+        pools = int(np.count_nonzero(graph.liquidity))//2
+
+        for engine in engines:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                try:
+                    results = executor.submit(benchEngine, engine, instance, tokens).result()
+                except Exception as error:
+                    results = [{'phase': 'error', 'seconds': None, 'value': repr(error)}]
+
+            with open(resultFile, 'a') as f:
+                for result in results:
+                    record = dict(version, n=n, pools=pools, density=density, reserves=reserves, demand=demand,
+                                  buckets=buckets, seed=seed, engine=engine, **result)
+                    f.write(json.dumps(record) + '\n')
+                    print(n, pools, engine.ljust(20), result['phase'].ljust(12), result['seconds'], result['value'], sep='\t')
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Binary companion of the 'config.json' file.
+
+The json file stores the weights as nested dictionaries and the reserves of
+every pool we have data on. The solvers only need the pools between the
+tokens of the config, so getConfig.py also writes the config as arrays into
+a folder next to the json file:
+
+    config_arrays/
+        meta.json           blocks, bucket names, mtime and size of the json
+        tokens.npy          token addresses, the token index
+        symbols.npy         token symbols
+        demand.npy          (n, n, B) trade counts per ordered pair and bucket
+        volume.npy          (n, n) total volume per ordered pair
+        tradesizes.npy      (B,) trade size of each bucket
+        ranges.npy          (B, 2) rangeLow and rangeUp of each bucket
+        pools.npy           addresses of the pools between tokens of the index
+        edges.npy           (E, 2) token0 and token1 of each pool as token ids
+        liquidity.npy       (E,) reserves of each pool
+
+The arrays are loaded memory-mapped and graphModel.py builds the graph
+directly from them (see loadArrays), the nested dictionaries of the json file
+are only rebuilt for the scripts that print or plot them. The binary version
+is only used while mtime and size of the json file match the ones it was
+written from.
+
+Running this file converts an existing json config:
+    python binaryConfig.py config.json
+
+"""
+
+import numpy as np
+import pathlib
+import json
+import os
+import sys
+
+
+
+arrayNames = ['tokens', 'symbols', 'demand', 'volume', 'tradesizes', 'ranges', 'pools', 'edges', 'liquidity']
+
+
+
+'''
+INPUT:
+    filename: path to the json config
+
+OUTPUT:
+    directory: folder of the binary version of the config
+'''
+def binaryDirectory(filename):
+    file = pathlib.Path(filename)
+    return pathlib.Path(file.parent/(file.stem + '_arrays'))
+
+
+
+'''
+INPUT:
+    config: config dictionary as written to the json file
+
+OUTPUT:
+    arrays: dictionary with the arrays of the binary config and its 'meta'
+        information (blocks, size, buckets), as returned by loadBinaryConfig
+'''
+def configArrays(config):
+    weights = config['weights']
+    reserves = config['reserves']
+
+    tokens = list(weights)
+    tokenId = {token: i for i, token in enumerate(tokens)}
+    buckets = list(weights[tokens[0]][tokens[0]]['buckets'])
+
+    n = len(tokens)
+    demand = np.zeros((n, n, len(buckets)))
+    volume = np.zeros((n, n))
+    for i, token1 in enumerate(tokens):
+        for j, token2 in enumerate(tokens):
+            volume[i, j] = weights[token1][token2]['totalVol']
+            for b, bucket in enumerate(buckets):
+                demand[i, j, b] = weights[token1][token2]['buckets'][bucket]['count']
+
+    bucketInfo = weights[tokens[0]][tokens[0]]['buckets']
+    tradesizes = np.array([bucketInfo[bucket]['tradesize'] for bucket in buckets], dtype=float)
+    ranges = np.array([[bucketInfo[bucket]['rangeLow'], bucketInfo[bucket]['rangeUp']] for bucket in buckets], dtype=float)
+
+    pools = []
+    edges = []
+    liquidity = []
+    for pool in reserves:
+        token0 = reserves[pool]['token0']
+        token1 = reserves[pool]['token1']
+        if token0 in tokenId and token1 in tokenId:
+            pools.append(pool)
+            edges.append([tokenId[token0], tokenId[token1]])
+            liquidity.append(reserves[pool]['reserves'])
+
+    return {
+        'meta': {
+            'blocks': config['blocks'],
+            'size': config['size'],
+            'buckets': buckets
+        },
+        'tokens': np.array(tokens, dtype=str),
+        'symbols': np.array([weights[token]['symb'] for token in tokens], dtype=str),
+        'demand': demand,
+        'volume': volume,
+        'tradesizes': tradesizes,
+        'ranges': ranges,
+        'pools': np.array(pools, dtype=str),
+        'edges': np.array(edges, dtype=np.int32).reshape(-1, 2),
+        'liquidity': np.array(liquidity, dtype=float)
+    }
+
+
+
+'''
+INPUT:
+    config: config dictionary as written to the json file
+    filename: path of the json file the config was written to
+
+OUTPUT:
+    writes the binary version of the config next to the json file.
+        meta.json is written last so an interrupted write is never used.
+'''
+def writeBinaryConfig(config, filename):
+    directory = binaryDirectory(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    arrays = configArrays(config)
+    for name in arrayNames:
+        np.save(pathlib.Path(directory/(name + '.npy')), arrays[name])
+
+    stat = os.stat(filename)
+    with open(pathlib.Path(directory/'meta.json'), 'w') as f:
+        meta = dict(arrays['meta'], mtime=stat.st_mtime_ns, fileSize=stat.st_size)
+        json.dump(meta, f)
+
+
+
+'''
+INPUT:
+    filename: path to the json config
+
+OUTPUT:
+    True if there is a binary version written from the current json file
+'''
+def hasBinaryConfig(filename):
+    metaFile = pathlib.Path(binaryDirectory(filename)/'meta.json')
+    if not os.path.exists(metaFile):
+        return False
+
+    with open(metaFile) as f:
+        meta = json.load(f)
+
+    stat = os.stat(filename)
+    return meta['mtime'] == stat.st_mtime_ns and meta['fileSize'] == stat.st_size
+
+
+
+'''
+INPUT:
+    filename: path to the json config
+
+OUTPUT:
+    arrays: dictionary with the memory-mapped arrays of the binary config and
+        its 'meta' information
+'''
+def loadBinaryConfig(filename):
+    directory = binaryDirectory(filename)
+    with open(pathlib.Path(directory/'meta.json')) as f:
+        arrays = {'meta': json.load(f)}
+
+    for name in arrayNames:
+        arrays[name] = np.load(pathlib.Path(directory/(name + '.npy')), mmap_mode='r')
+
+    return arrays
+
+
+
+'''
+INPUT:
+    filename: path to the json config
+
+OUTPUT:
+    arrays: the arrays of the config (see configArrays). They are memory-mapped
+        from the binary version if it is up to date, otherwise they are built
+        from the json file.
+'''
+def loadArrays(filename):
+    if hasBinaryConfig(filename):
+        return loadBinaryConfig(filename)
+
+    with open(filename) as f:
+        return configArrays(json.load(f))
+
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'config.json'
+    with open(filename) as f:
+        config = json.load(f)
+
+    writeBinaryConfig(config, filename)
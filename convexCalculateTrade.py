@@ -7,48 +7,30 @@ Created on Sat Jun 11 18:25:39 2022
 
 import cvxpy as cp
 import numpy as np
-import itertools
-import pathlib
-import json
+import graphModel
+import convexModel
+import dualRouter
+import solverStrategy
+import collections
 import matplotlib.pyplot as plt
+import concurrent.futures
+import itertools
 
 
 
 """
 PROBLEM DATA:
 
-We grab the basic information from the json file and construct
+The problem data is constructed once per config file in graphModel.py:
     nodes (list)
     edges (list)
     currentLiquidity (dict)
     scaledLiquidity (dict)
-    weights (dict)
-
-currentLiquidity dictionary does not have a pool for each pair.
-scaledLiquidity dicitionary scales values in currentLiquidity dictionary
-    by the totalLiquidity in all pools together.
-    
-weights are based on the counted number of trades of a certain size and pair
-    and are normalized by the total number of trades of any size and pair
+    weights (dict), only built for the output
 """
 
 # config file is generated by getConfig.py
 filename = 'config.json'
-file = pathlib.Path(filename)
-
-text = open(filename)
-config = json.load(text)
-    
-n = config['size']
-weights = config['weights']
-reserves = config['reserves']
-
-
-# Construct the rest of the problemdata
-nodes = []
-edges = []
-currentLiquidity = {}
-scaledLiquidity = {}
 
 # Precision is for rounding in scaledLiquidities
 precision = 4
@@ -56,202 +38,294 @@ precision = 4
 # Fee is for the computation of the CPMM
 fee = 0.003
 
-for token1, token2 in itertools.permutations(weights, 2):
-    nodes.append(token1)
-    nodes.append(token2)
-    edges.append((token1, token2))
+# Solver strategy (see solverStrategy.py) and wall-clock budget in seconds
+# of every solve, None for no limit
+strategy = 'reference'
+timeBudget = None
+
+# Solver, options and status of the solves (see solverStrategy.solve)
+solverRecords = []
+
+# Config files of further liquidity snapshots, solved with the demand of 'filename' (see solveSnapshots)
+snapshotFiles = []
+
+# Start SCS from the solution of the previous snapshot. This is much faster,
+# but SCS then stops earlier: the objectives are within 3e-3 of the optimum
+# instead of 7e-4 (see SOLVING SNAPSHOTS), more than the snapshots usually
+# differ by. Clarabel always starts cold.
+warmStart = False
+
+# With the liquidity fixed every (start, goal, bucket) is a problem of its own.
+# Solve them one by one instead of as one problem (see solveDecomposed),
+# in 'workers' processes.
+decomposed = False
+workers = 1
+
+# Leave the pools without liquidity out of the problem, they can't carry any
+# flow. Snapshots with liquidity in pools that are empty in 'filename' are
+# solved with the union of the pools of all snapshots (see getProblem).
+# Nothing arrives from a start token left without pools (see convexModel.py).
+prunePools = True
+
+# Solve the blocks with the dual decomposition of dualRouter.py instead of
+# cvxpy, milliseconds per block for CPMM pools
+dual = False
+
+graph = graphModel.loadGraph(filename, precision)
+
+nodes = graph.nodes
+edges = graph.edges
+currentLiquidity = graph.currentLiquidity
+scaledLiquidity = graph.scaledLiquidity
+buckets = graph.buckets
+totalLiquidity = graph.totalLiquidity
+
+n = graph.n
+m = graph.m
+
+# Pools in the problem
+pools = np.flatnonzero(graph.liquidity) if prunePools else np.arange(m)
     
-nodes = list(set(nodes))
 
-n = len(nodes)
-m = len(edges)
+"""
+CONSTRUCTING THE PROBLEM:
+    
+We construct variables for pool levels after routing from x to y for every
+    (start, goal, bucket) and every pool in 'pools'. They are stacked into the
+    vectors of convexModel.py, so the constraints of all of them are a few
+    vectorized constraints.
+    
+The objective function and constraints are also created in this section.
 
+"""
 
-# construct 'edge - reserve' dict
-totalLiquidity = 0
-for pool in reserves:
-    if pool in currentLiquidity:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])] += reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])] += reserves[pool]['reserves']
-    else:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])] = reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])] = reserves[pool]['reserves']
+# Parameter
+liquidity = cp.Parameter(m, nonneg=True, name='prerouting liquidity')
 
-    if (reserves[pool]['token0'], reserves[pool]['token1']) in edges:
-        totalLiquidity += reserves[pool]['reserves']
+# Variables, Objective and Constraints
+objective_expression, constraints, variables = convexModel.buildRouting(graph, liquidity, fee, pools=pools)
+new = variables['new0'], variables['new1']
+arrived_liquidity = variables['arrived']
 
-for pool in edges:
-    if pool in currentLiquidity:
-        scaledLiquidity[pool] = round(currentLiquidity[pool]/totalLiquidity, precision)
-    else:
-        scaledLiquidity[pool] = 0
-
-
-# construct weights dict
-totTrades = 0
-for token1, token2 in itertools.permutations(nodes, 2):
-    buckets = weights[token1][token2]['buckets']
-    for bucket in buckets:
-        totTrades += buckets[bucket]['count']
-        
-for token1, token2 in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        weights[token1][token2]['buckets'][bucket]['count'] /= totTrades
-    
+objective = cp.Maximize(objective_expression)
 
-"""
-ADDITIONAL TOOLS:
 
-Degree Matrices are used to construct problem instance.
+prob = cp.Problem(objective, constraints)
 
-"""
+# Problems already built for a set of pools, with their liquidity parameter
+problems = {pools.tobytes(): (prob, liquidity)}
+
+
+
+'''
+INPUT:
+    problemPools: sorted array with the ids of the pools of the problem
+
+OUTPUT:
+    problem: the routing problem of all blocks over these pools, built once
+        per set of pools like 'prob'
+    parameter: its liquidity parameter of shape (m,)
+'''
+def getProblem(problemPools):
+    key = problemPools.tobytes()
+    if key not in problems:
+        parameter = cp.Parameter(m, nonneg=True, name='prerouting liquidity')
+        problemObjective, problemConstraints, problemVariables = convexModel.buildRouting(graph, parameter, fee, pools=problemPools)
+        problems[key] = (cp.Problem(cp.Maximize(problemObjective), problemConstraints), parameter)
 
-# Degree Matrices
-# Used in the constraints to sum over variables that represent pools containing a given currency
-sum_all = {}
-for token in nodes:
-    sum_all_token = np.zeros((2,m), dtype=int)
+    return problems[key]
 
-    for i in range(m):
-        if token == edges[i][0]:
-            sum_all_token[0][i] = 1
-            
-        elif token == edges[i][1]:
-            sum_all_token[1][i] = 1
 
-    sum_all[token] = sum_all_token
+
+'''
+INPUT:
+    snapshots: liquidity configurations (see solveSnapshots)
+
+OUTPUT:
+    problemPools: 'pools' together with every pool that has liquidity in
+        one of the snapshots
+'''
+def getSnapshotPools(snapshots):
+    if not prunePools or not len(snapshots):
+        return pools
+
+    return np.union1d(pools, np.flatnonzero(np.any(np.array(snapshots) != 0, axis=0)))
+
 
 
 
 """
-CONSTRUCTING THE PROBLEM:
-    
-We construct variables for pool levels before routing (old) and 
-    for pool levels after routing from x to y (new[x][y]).
-    
-The objective function and constraints are also created in this section.
+SOLVING SNAPSHOTS:
+
+The liquidity is a parameter of the problem, so cvxpy canonicalizes the
+problem once and only puts in the new liquidity for every further solve.
+The problem is vectorized (see convexModel.py), so this only saves about
+10 ms a solve and almost all of the time is spent in the solver.
+
+With 'warmStart' every solve starts SCS from the solution of the previous
+one. On a 3-token config with the 'reference' strategy, 5 snapshots of
+liquidity within about 5% of each other took 1.3 s instead of 92 s. The
+objectives were 1e-3 to 3e-3 below the exact ones of dualRouter.py, compared
+with 6e-4 when every solve started cold. Tighter tolerances of SCS take
+the time back. The error is larger than the differences between the
+snapshots, so warmStart is off by default. Turn it on for a quick look at
+many snapshots, not to compare them.
 
 """
 
-# Parameter
-liquidity = cp.Parameter((m, 1), nonneg=True, name='prerouting liquidity')
-
-# Variables
-new = {}
-arrived_liquidity = {}
-for token1 in nodes:
-    new[token1] = {}
-    arrived_liquidity[token1] = {}
-    for token2 in nodes:
-        if token1 != token2:
-            new[token1][token2] = {}
-            arrived_liquidity[token1][token2] = {}
-            for bucket in buckets:
-                new[token1][token2][bucket] = cp.Variable((m,2), nonneg=True, name='postrouting liquidity')
-                arrived_liquidity[token1][token2][bucket] = cp.Variable(nonneg=True, name='arrived liqudity')
+'''
+INPUT:
+    file: path to a config file with the same tokens as 'filename'
 
+OUTPUT:
+    snapshot: array (m,) with the liquidity of every pool in 'edges' in the
+        config, scaled by the totalLiquidity of 'filename' and rounded
+'''
+def getSnapshot(file):
+    snapshot = graphModel.loadGraph(file, precision)
+    return np.round(np.array([snapshot.currentLiquidity.get(pool, 0) for pool in edges])/totalLiquidity, precision)
 
-# Objective
-objective_expression = 0
-for start, goal in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        objective_expression += weights[start][goal]['buckets'][bucket]['count'] * arrived_liquidity[start][goal][bucket]
 
-objective = cp.Maximize(objective_expression)
 
+'''
+INPUT:
+    snapshots: liquidity configurations, each an array (m,) with the scaled
+        liquidity of every pool in 'edges' (like graph.liquidity)
 
-# Constraints
-constraints = []
-
-for start, goal in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        
-        for token in nodes:
-            if token == start:
-                # Inserted Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == buckets[bucket]['tradesize']/totalLiquidity
-                ]
-            
-            elif token == goal:
-                # Removed Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == (-1)*arrived_liquidity[start][goal][bucket]
-                ]
-            
-            else:
-                # Preserved Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == 0
-                ]
-                
-
-        for i in range(m):
-            # Constant Product Constraint
-            constraints += [
-                liquidity[i, 0] <= cp.geo_mean(
-                    cp.hstack(
-                        [fee * liquidity[i, 0] + (1-fee) * new[start][goal][bucket][i, 0],
-                         new[start][goal][bucket][i, 1]]
-                    )
-                )
-            ]
-
-            # First coordinate of a pool is the increasing currency
-            constraints += [
-                liquidity[i, 0] - new[start][goal][bucket][i, 0] <= 0
-            ]
+OUTPUT:
+    averageTrades: list with the optimal objective of every snapshot
+'''
+def solveSnapshots(snapshots):
+    if dual:
+        return [dualRouter.getObjective(graph, snapshot, fee)[0] for snapshot in snapshots]
 
+    if decomposed:
+        return solveDecomposed(snapshots)
 
-prob = cp.Problem(objective, constraints)
+    problem, parameter = getProblem(getSnapshotPools(snapshots))
 
+    averageTrades = []
+    for snapshot in snapshots:
+        parameter.value = snapshot
+        averageTrade, record = solverStrategy.solve(problem, strategy, timeBudget, warm_start=warmStart)
+        averageTrades.append(averageTrade)
+        solverRecords.append(record)
 
+    return averageTrades
 
 
-"""
-START SOLVING
 
-We do a simple gradient descent where we move a 'delta' unit of $$ between
-the two pools with the best improvement until we plateau.
+# Problems of the (start, goal, bucket) blocks already built in this process
+blockProblems = {}
 
-"""
+'''
+INPUT:
+    snapshot: liquidity configuration (see solveSnapshots)
+    block: (start, goal, bucket) to route
+    problemPools: ids of the pools of the problem (see getSnapshotPools)
 
-accuracy = 1e-8
-maxIterations = 10000000
-averageTrades = []
+OUTPUT:
+    arrived: the optimal arrived liquidity of the block alone. The problem
+        of a block is only built once per process and set of pools.
+    record: the solver record of the block (see solverStrategy.solve)
+'''
+def solveBlock(snapshot, block, problemPools):
+    key = (block, problemPools.tobytes())
+    if key not in blockProblems:
+        blockLiquidity = cp.Parameter(m, nonneg=True, name='prerouting liquidity')
+        blockObjective, blockConstraints, blockVariables = convexModel.buildRouting(graph, blockLiquidity, fee, [block], problemPools)
+        blockProblems[key] = (cp.Problem(cp.Maximize(cp.sum(blockVariables['arrived'])), blockConstraints), blockLiquidity)
 
-npLiquidity = np.zeros((m,1))
-for i in range(m):
-    npLiquidity[i,0] = scaledLiquidity[edges[i]]
-    
-liquidity.value = npLiquidity
+    problem, blockLiquidity = blockProblems[key]
+    blockLiquidity.value = snapshot
 
-averageTrade = prob.solve(solver='SCS', verbose=False, max_iters=maxIterations, eps=accuracy)
-    
-averageInput = 0
-for token1 in nodes:
-    for token2 in nodes:
-        buckets = weights[token1][token2]['buckets']
-        for bucket in buckets:
-            averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']    
-
-print('average input:\t', averageInput)
-print('average trade:\t', averageTrade*totalLiquidity)
-
-print('tokens:')
-for node in nodes:
-    print('\t', weights[node]['symb'])
-    
+    return solverStrategy.solve(problem, strategy, timeBudget, warm_start=warmStart)
+
+
+
+'''
+INPUT:
+    snapshots: liquidity configurations (see solveSnapshots)
+
+OUTPUT:
+    averageTrades: list with the optimal objective of every snapshot, the
+        sum of the arrived liquidity of every block weighted by its count.
+        Blocks without trades are left out.
+'''
+def solveDecomposed(snapshots):
+    blocks = []
+    for start, goal, bucket in convexModel.getBlocks(graph):
+        if graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]]:
+            blocks.append((start, goal, bucket))
+
+    tasks = [(s, block) for s in range(len(snapshots)) for block in blocks]
+    taskSnapshots = [snapshots[s] for s, block in tasks]
+    taskBlocks = [block for s, block in tasks]
+    problemPools = itertools.repeat(getSnapshotPools(snapshots))
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(solveBlock, taskSnapshots, taskBlocks, problemPools, chunksize=max(1, len(tasks)//(4*workers))))
+    else:
+        results = list(map(solveBlock, taskSnapshots, taskBlocks, problemPools))
+
+    averageTrades = [0]*len(snapshots)
+    for (s, (start, goal, bucket)), (blockArrived, record) in zip(tasks, results):
+        averageTrades[s] += graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]] * blockArrived
+        solverRecords.append(record)
+
+    return averageTrades
+
+
+
+if __name__ == '__main__':
+    """
+    START SOLVING
+
+    We do a simple gradient descent where we move a 'delta' unit of $$ between
+    the two pools with the best improvement until we plateau.
+
+    """
+
+    averageTrades = solveSnapshots([graph.liquidity] + [getSnapshot(file) for file in snapshotFiles])
+    averageTrade = averageTrades[0]
+
+    # the weights dictionary is only built for the output
+    weights = graph.weights
+
+    averageInput = 0
+    for token1 in nodes:
+        for token2 in nodes:
+            buckets = weights[token1][token2]['buckets']
+            for bucket in buckets:
+                averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']    
+
+    print('average input:\t', averageInput)
+    print('average trade:\t', averageTrade*totalLiquidity)
+
+    for file, snapshotTrade in zip(snapshotFiles, averageTrades[1:]):
+        print('average trade:\t', snapshotTrade*totalLiquidity, '\t', file)
+
+    print('solved with:')
+    if dual:
+        print('\t dual decomposition (see dualRouter.py)')
+    for description, count in collections.Counter(solverStrategy.describe(record) for record in solverRecords).items():
+        print('\t', count, 'x', description)
+
+    print('tokens:')
+    for node in nodes:
+        print('\t', weights[node]['symb'])
+
+
+    plotPools = []
+    plotLiq = []
+    for (x,y) in scaledLiquidity:
+        if not str((weights[y]['symb'], weights[x]['symb'])) in plotPools:
+            plotPools.append(str((weights[x]['symb'], weights[y]['symb'])))
+            plotLiq.append(scaledLiquidity[(x,y)])
 
-plotPools = []
-plotLiq = []
-for (x,y) in scaledLiquidity:
-    if not str((weights[y]['symb'], weights[x]['symb'])) in plotPools:
-        plotPools.append(str((weights[x]['symb'], weights[y]['symb'])))
-        plotLiq.append(scaledLiquidity[(x,y)])
-        
-plt.bar(plotPools, plotLiq)
-plt.xticks(rotation='vertical')
-plt.xlabel('current configuration')
-plt.ylabel('level')
-plt.show()
\ No newline at end of file
+    plt.bar(plotPools, plotLiq)
+    plt.xticks(rotation='vertical')
+    plt.xlabel('current configuration')
+    plt.ylabel('level')
+    plt.show()
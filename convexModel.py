@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized formulation of the CFMM routing problem of convexCalculateTrade.py
+and convexOptimizeTrade.py.
+
+Every (start, goal, bucket) is a block k. Instead of a (m, 2) variable and
+one constraint per token and pool for every block, the liquidities after
+routing of all blocks are stacked into two vectors of length K*m, the
+entry k*m + i belonging to pool i of block k:
+    new0: first coordinate, the currency put into the pool
+    new1: second coordinate, the currency taken out of the pool
+
+The constraints of all blocks are then a few large ones:
+    conservation: sum over the pools leaving a token of (new0 - liquidity)
+        plus sum over the pools entering it of (new1 - liquidity) is the
+        tradesize for the start, -arrived for the goal and 0 otherwise.
+        With the sparse incidence matrices 'outgoing' and 'incoming' (n, m)
+        this is one equation with kron(I_K, outgoing) and kron(I_K, incoming).
+    constant product: liquidity <= geo_mean(fee*liquidity + (1-fee)*new0, new1)
+        for every pool of every block, as liquidity <= root and one vector of
+        rotated second order cones ||(a - new1, 2*root)|| <= a + new1 with
+        a = fee*liquidity + (1-fee)*new0.
+    increasing: new0 >= liquidity
+
+So the time to build the problem grows with the size of the data, not with
+the number of constraints.
+
+A pool without liquidity can't carry any flow, so the formulation can be
+restricted to a subset of the pools ('pools'). The stacked vectors then
+have length K*len(pools) and the incidence matrices only the columns of
+these pools, so the size of the problem grows with the number of pools with
+liquidity instead of with n^2.
+This is exact except for a start token without any pool in 'pools', e.g.
+when all of its pools round to 0 at the precision of the config: the trade
+can't leave the start, but its row of the conservation constraint would read
+0 == tradesize and the problem would be infeasible. Without pruning the trade
+is sunk into an empty pool and nothing arrives, so these blocks put in
+nothing and their arrived liquidity is fixed at 0, as in dualRouter.py.
+
+"""
+
+import cvxpy as cp
+import numpy as np
+import scipy.sparse as sp
+import itertools
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    pools: ids of the pools to include, all of them if None
+
+OUTPUT:
+    outgoing: sparse (n, len(pools)) matrix with a 1 at (source, i) of the
+        i-th pool in 'pools'
+    incoming: sparse (n, len(pools)) matrix with a 1 at (target, i) of the
+        i-th pool in 'pools'
+'''
+def incidenceMatrices(graph, pools=None):
+    if pools is None:
+        pools = np.arange(graph.m)
+
+    columns = np.arange(len(pools))
+    ones = np.ones(len(pools))
+
+    outgoing = sp.csr_matrix((ones, (graph.source[pools], columns)), shape=(graph.n, len(pools)))
+    incoming = sp.csr_matrix((ones, (graph.target[pools], columns)), shape=(graph.n, len(pools)))
+
+    return outgoing, incoming
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+
+OUTPUT:
+    blocks: list of (start, goal, bucket) in the order of the blocks of the
+        problem, the same order the scripts used for their variables
+'''
+def getBlocks(graph):
+    blocks = []
+    for start, goal in itertools.permutations(graph.nodes, 2):
+        for bucket in graph.bucketNames:
+            blocks.append((start, goal, bucket))
+
+    return blocks
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: cp.Parameter or cp.Variable of shape (m,) with the liquidity
+        of every pool before routing
+    fee: fee for the CPMM
+    blocks: list of (start, goal, bucket) to route, all of them if None
+    pools: ids of the pools the trades can be routed through, all of them
+        if None. The liquidity of the other pools is not used.
+
+OUTPUT:
+    objective: the demand weighted amount arrived, to be maximized
+    constraints: list of the constraints of the routing problem
+    variables: dictionary with the variables 'new0', 'new1', 'root'
+        (K*len(pools),) and 'arrived' (K,), block k in the order of 'blocks'
+        and pool i in the order of 'pools'
+'''
+def buildRouting(graph, liquidity, fee, blocks=None, pools=None):
+    if blocks is None:
+        blocks = getBlocks(graph)
+    if pools is None:
+        pools = np.arange(graph.m)
+
+    K = len(blocks)
+    n = graph.n
+    m = len(pools)
+    if m < graph.m:
+        liquidity = liquidity[pools]
+
+    starts = np.array([graph.tokenId[start] for start, goal, bucket in blocks], dtype=np.int64)
+    goals = np.array([graph.tokenId[goal] for start, goal, bucket in blocks], dtype=np.int64)
+    bucketIds = np.array([graph.bucketNames.index(bucket) for start, goal, bucket in blocks], dtype=np.int64)
+
+    outgoing, incoming = incidenceMatrices(graph, pools)
+    identity = sp.identity(K, format='csr')
+
+    # liquidity of every pool repeated for every block
+    repeat = sp.kron(np.ones((K, 1)), sp.identity(m), format='csr')
+    # conservation, the rows k*n + t belong to token t of block k
+    out = sp.kron(identity, outgoing, format='csr')
+    into = sp.kron(identity, incoming, format='csr')
+    degree = sp.kron(np.ones((K, 1)), outgoing + incoming, format='csr')
+    goal = sp.csr_matrix((np.ones(K), (np.arange(K)*n + goals, np.arange(K))), shape=(K*n, K))
+
+    # blocks whose start token has no pool to put the trade into
+    stuck = np.asarray((outgoing + incoming).sum(axis=1)).ravel()[starts] == 0
+
+    inserted = np.zeros(K*n)
+    inserted[np.arange(K)*n + starts] = np.where(stuck, 0, graph.tradesizes[bucketIds]/graph.totalLiquidity)
+
+    new0 = cp.Variable(K*m, nonneg=True, name='postrouting liquidity in')
+    new1 = cp.Variable(K*m, nonneg=True, name='postrouting liquidity out')
+    arrived = cp.Variable(K, nonneg=True, name='arrived liquidity')
+    root = cp.Variable(K*m, name='geometric mean')
+
+    objective = graph.demand[starts, goals, bucketIds] @ arrived
+
+    old = repeat @ liquidity
+    product = fee * old + (1-fee) * new0
+    constraints = [
+        # Inserted, Removed and Preserved Liquidity Constraints
+        out @ new0 + into @ new1 - degree @ liquidity + goal @ arrived == inserted,
+
+        # Constant Product Constraint, the geometric mean is the variable
+        # 'root' as in the canonicalization of cp.geo_mean, SCS converges
+        # much slower with the liquidity in the cone directly
+        old <= root,
+        cp.SOC(product + new1, cp.vstack([product - new1, 2*root]), axis=0),
+
+        # First coordinate of a pool is the increasing currency
+        old - new0 <= 0
+    ]
+
+    if stuck.any():
+        constraints.append(arrived[np.flatnonzero(stuck)] == 0)
+
+    variables = {
+        'new0': new0,
+        'new1': new1,
+        'root': root,
+        'arrived': arrived
+    }
+
+    return objective, constraints, variables
@@ -7,48 +7,29 @@ Created on Sat Jun 11 18:25:39 2022
 
 import cvxpy as cp
 import numpy as np
-import itertools
-import pathlib
-import json
+import graphModel
+import convexModel
+import solverStrategy
+import collections
 import matplotlib.pyplot as plt
+import concurrent.futures
+import itertools
 
 
 
 """
 PROBLEM DATA:
 
-We grab the basic information from the json file and construct
+The problem data is constructed once per config file in graphModel.py:
     nodes (list)
     edges (list)
     currentLiquidity (dict)
     scaledLiquidity (dict)
-    weights (dict)
-
-currentLiquidity dictionary does not have a pool for each pair.
-scaledLiquidity dicitionary scales values in currentLiquidity dictionary
-    by the totalLiquidity in all pools together.
-    
-weights are based on the counted number of trades of a certain size and pair
-    and are normalized by the total number of trades of any size and pair
+    weights (dict), only built for the output
 """
 
 # config file is generated by getWeights() in weightmaker.py
 filename = 'config.json'
-file = pathlib.Path(filename)
-
-text = open(filename)
-config = json.load(text)
-    
-n = config['size']
-weights = config['weights']
-reserves = config['reserves']
-
-
-# Construct the rest of the problemdata
-nodes = []
-edges = []
-currentLiquidity = {}
-scaledLiquidity = {}
 
 # Precision is for rounding in scaledLiquidities
 precision = 4
@@ -56,165 +37,94 @@ precision = 4
 # Fee is for the computation of the CPMM
 fee = 0.003
 
-for token1, token2 in itertools.permutations(weights, 2):
-    nodes.append(token1)
-    nodes.append(token2)
-    edges.append((token1, token2))
-    
-nodes = list(set(nodes))
+# Solver strategy (see solverStrategy.py) and wall-clock budget in seconds
+# of every solve, None for no limit
+strategy = 'reference'
+timeBudget = None
 
-n = len(nodes)
-m = len(edges)
+# Solver, options and status of the solves (see solverStrategy.solve)
+solverRecords = []
 
+# Solve with consensus ADMM instead of one problem for all blocks (see solveADMM),
+# the blocks of an iteration are solved in 'workers' processes
+admm = False
+workers = 1
 
-# construct 'edge - reserve' dict
-totalLiquidity = 0
-for pool in reserves:
-    if pool in currentLiquidity:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])] += reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])] += reserves[pool]['reserves']
-    else:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])] = reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])] = reserves[pool]['reserves']
-
-    if (reserves[pool]['token0'], reserves[pool]['token1']) in edges:
-        totalLiquidity += reserves[pool]['reserves']
-
-for pool in edges:
-    if pool in currentLiquidity:
-        scaledLiquidity[pool] = round(currentLiquidity[pool]/totalLiquidity, precision)
-    else:
-        scaledLiquidity[pool] = 0
-
-
-# construct weights dict
-totTrades = 0
-for token1, token2 in itertools.permutations(nodes, 2):
-    buckets = weights[token1][token2]['buckets']
-    for bucket in buckets:
-        totTrades += buckets[bucket]['count']
-        
-for token1, token2 in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        weights[token1][token2]['buckets'][bucket]['count'] /= totTrades
-        
-totalScaledLiquidity = 0
-for i in range(m):
-    totalScaledLiquidity += scaledLiquidity[edges[i]]
-    
+# ADMM penalty relative to the curvature of the objective of an average block,
+# it is adapted to balance the residuals
+admmRho = 1
 
-"""
-ADDITIONAL TOOLS:
+# Over-relaxation of the local liquidities in the consensus step, 1 for none
+admmRelaxation = 1.6
 
-Degree Matrices are used to construct problem instance.
+# Solver strategy of the local solves of the blocks in every ADMM iteration,
+# they get the same 'timeBudget' as every other solve
+admmStrategy = 'production'
 
-"""
+# Minimal and maximal number of ADMM iterations and tolerance of the relative residuals
+admmMinIterations = 10
+admmIterations = 500
+admmTolerance = 1e-3
 
-# Degree Matrices
-# Used in the constraints to sum over variables that represent pools containing a given currency
-sum_all = {}
-for token in nodes:
-    sum_all_token = np.zeros((2,m), dtype=int)
+# Only put liquidity into the pools that have some in the config. The other
+# pools are left out of the problem, which is then much smaller for sparse
+# graphs, but the optimum can't open new pools.
+prunePools = False
 
-    for i in range(m):
-        if token == edges[i][0]:
-            sum_all_token[0][i] = 1
-            
-        elif token == edges[i][1]:
-            sum_all_token[1][i] = 1
+graph = graphModel.loadGraph(filename, precision)
 
-    sum_all[token] = sum_all_token
+nodes = graph.nodes
+edges = graph.edges
+currentLiquidity = graph.currentLiquidity
+scaledLiquidity = graph.scaledLiquidity
+buckets = graph.buckets
+totalLiquidity = graph.totalLiquidity
+totalScaledLiquidity = graph.totalScaledLiquidity
 
+n = graph.n
+m = graph.m
 
+# Pools that can get liquidity
+pools = np.flatnonzero(graph.liquidity) if prunePools else np.arange(m)
+    
 
 """
 CONSTRUCTING THE PROBLEM:
     
 We construct variables for pool levels before routing (old) and 
-    for pool levels after routing from x to y (new[x][y]).
+    for pool levels after routing from x to y for every (start, goal, bucket).
+    The latter are stacked into the vectors of convexModel.py, so the
+    constraints of all of them are a few vectorized constraints.
     
 The objective function and constraints are also created in this section.
 
 """
 
 # Variables
-liquidity = cp.Variable((m, 1), nonneg=True, name='prerouting liquidity')
-new = {}
-arrived_liquidity = {}
-for token1 in nodes:
-    new[token1] = {}
-    arrived_liquidity[token1] = {}
-    for token2 in nodes:
-        if token1 != token2:
-            new[token1][token2] = {}
-            arrived_liquidity[token1][token2] = {}
-            for bucket in buckets:
-                new[token1][token2][bucket] = cp.Variable((m,2), nonneg=True, name='postrouting liquidity')
-                arrived_liquidity[token1][token2][bucket] = cp.Variable(nonneg=True, name='arrived liqudity')
-
+liquidity = cp.Variable(m, nonneg=True, name='prerouting liquidity')
 
-# Objective
-objective_expression = 0
-for start, goal in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        objective_expression += weights[start][goal]['buckets'][bucket]['count'] * arrived_liquidity[start][goal][bucket]
+# Objective and Routing Constraints
+objective_expression, constraints, variables = convexModel.buildRouting(graph, liquidity, fee, pools=pools)
+new = variables['new0'], variables['new1']
+arrived_liquidity = variables['arrived']
 
 objective = cp.Maximize(objective_expression)
 
+# Same liquidity in both directions
+constraints += [
+    liquidity == liquidity[graph.reverse]
+]
 
-# Constraints
-constraints = []
-
-for start, goal in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        
-        for token in nodes:
-            if token == start:
-                # Inserted Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == buckets[bucket]['tradesize']/totalLiquidity
-                ]
-            
-            elif token == goal:
-                # Removed Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == (-1)*arrived_liquidity[start][goal][bucket]
-                ]
-            
-            else:
-                # Preserved Liquidity Constraint
-                constraints += [
-                    cp.trace(sum_all[token] @ (new[start][goal][bucket] - liquidity)) == 0
-                ]
-                
-
-        for i in range(m):
-            # Constant Product Constraint
-            constraints += [
-                liquidity[i, 0] <= cp.geo_mean(
-                    cp.hstack(
-                        [fee * liquidity[i, 0] + (1-fee) * new[start][goal][bucket][i, 0],
-                         new[start][goal][bucket][i, 1]]
-                    )
-                )
-            ]
-
-
-            # First coordinate of a pool is the increasing currency
-            constraints += [
-                liquidity[i, 0] - new[start][goal][bucket][i, 0] <= 0
-            ]
-            
-            
-            # Same liquidity in both directions
-            (x,y) = edges[i]
-            j = edges.index((y,x))
-            constraints += [
-                liquidity[i,0] == liquidity[j,0]
-            ]
-        
-        # Total Liquidity Constraint
-        cp.sum(liquidity) == totalScaledLiquidity
+# No liquidity in the pools left out
+if len(pools) < m:
+    constraints += [
+        liquidity[np.setdiff1d(np.arange(m), pools)] == 0
+    ]
+
+# Total Liquidity Constraint
+constraints += [
+    cp.sum(liquidity) == totalScaledLiquidity
+]
 
 
 prob = cp.Problem(objective, constraints)
@@ -223,50 +133,228 @@ prob = cp.Problem(objective, constraints)
 
 
 """
-START SOLVING
-
-We do a simple gradient descent where we move a 'delta' unit of $$ between
-the two pools with the best improvement until we plateau.
+ADMM:
+
+Every (start, goal, bucket) block gets a local copy of the liquidity. The
+blocks are only coupled by all copies being the same liquidity z, which has
+the same liquidity in both directions of a pool and sums up to the total.
+Consensus ADMM alternates between
+    1. every block maximizing its weighted arrived liquidity minus
+       rho/2 * ||local - z + u||^2 on its own (see solveLocal)
+    2. z being the projection of the average of local + u onto the symmetric
+       liquidities with the right total (see projectConsensus)
+    3. the scaled dual variables u of every block adding up local - z.
+The local liquidities are over-relaxed with 'admmRelaxation' in 2. and 3.
+
+rho starts at the curvature of the objective of an average block and both
+residuals are relative, to the liquidity and to the duals rho*u, so neither
+rho nor the stopping test depends on the scale of the trades. rho is doubled
+or halved to keep the relative residuals within a factor of 10, and no
+iteration before 'admmMinIterations' counts as converged.
+
+The objective is flat in the liquidity, so the local copies still differ a
+bit from z when the residuals are small. The objective returned is the one
+of z, solved with z fixed as in convexCalculateTrade.py. With the tiny trades
+of the real data the local solves are only accurate to about 1e-3, the
+residuals then stay above 'admmTolerance' and ADMM stops after
+'admmIterations' without converging.
 
 """
 
-accuracy = 1e-8
-maxIterations = 10000000
-averageTrades = []
+# Problems of the (start, goal, bucket) blocks already built in this process
+blockProblems = {}
+
+'''
+INPUT:
+    block: (start, goal, bucket)
+    center: array (m,), z - u of the block
+    rho: ADMM penalty
+
+OUTPUT:
+    local: array (m,) with the local liquidity of the block
+    arrived: arrived liquidity of the block
+    record: the solver record of the local solve (see solverStrategy.solve)
+'''
+def solveLocal(block, center, rho):
+    if block not in blockProblems:
+        local = cp.Variable(m, nonneg=True, name='local liquidity')
+        scale = cp.Parameter(nonneg=True, name='square root of rho/2')
+        target = cp.Parameter(m, name='scaled center')
+
+        blockObjective, blockConstraints, blockVariables = convexModel.buildRouting(graph, local, fee, [block], pools)
+        problem = cp.Problem(cp.Maximize(blockObjective - cp.sum_squares(scale*local - target)), blockConstraints)
+        blockProblems[block] = (problem, local, scale, target, blockVariables['arrived'])
+
+    problem, local, scale, target, arrived = blockProblems[block]
+    scale.value = np.sqrt(rho/2)
+    target.value = scale.value*center
+    value, record = solverStrategy.solve(problem, admmStrategy, timeBudget, warm_start=True)
+
+    return local.value, arrived.value[0], record
+
+
+
+'''
+INPUT:
+    v: array (m,) with a liquidity for every pool
+
+OUTPUT:
+    z: the closest liquidity to v that is nonnegative, the same in both
+        directions of a pool, sums up to totalScaledLiquidity and is 0
+        outside of 'pools'
+'''
+def projectConsensus(v):
+    v = (v + v[graph.reverse])/2
+
+    # projection onto {z >= 0, sum(z) = totalScaledLiquidity}, it keeps the symmetry
+    descending = np.sort(v[pools])[::-1]
+    excess = np.cumsum(descending) - totalScaledLiquidity
+    k = np.nonzero(descending - excess/np.arange(1, len(pools)+1) > 0)[0][-1]
+
+    z = np.zeros(m)
+    z[pools] = np.maximum(v[pools] - excess[k]/(k+1), 0)
+
+    return z
+
+
+
+'''
+OUTPUT:
+    z: the consensus liquidity
+    objective: the demand weighted arrived liquidity of all blocks with the
+        liquidity fixed to z
+    history: list with the diagnostics of every iteration, a dictionary with
+        'iteration', 'objective', relative 'primal' and 'dual' residual, 'rho' and
+        whether the residuals are 'converged'
+'''
+def solveADMM():
+    blocks = convexModel.getBlocks(graph)
+    counts = np.array([graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]] for start, goal, bucket in blocks])
+    K = len(blocks)
+
+    # curvature of the objective of an average block in the liquidity of a
+    # pool, about count*tradesize^2/liquidity^3, with the tradesizes scaled
+    # like the liquidity
+    tradesizes = np.array([buckets[bucket]['tradesize'] for start, goal, bucket in blocks])/totalLiquidity
+    poolLiquidity = totalScaledLiquidity/len(pools)
+    rho = admmRho * (counts @ tradesizes**2)/(K*poolLiquidity**3)
+
+    z = projectConsensus(graph.liquidity)
+    u = np.zeros((K, m))
+    history = []
+
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    for iteration in range(admmIterations):
+        centers = list(z - u)
+        if executor is not None:
+            results = list(executor.map(solveLocal, blocks, centers, itertools.repeat(rho), chunksize=max(1, K//(4*workers))))
+        else:
+            results = list(map(solveLocal, blocks, centers, itertools.repeat(rho)))
+
+        local = np.array([result[0] for result in results])
+        arrived = np.array([result[1] for result in results])
+        solverRecords.extend(result[2] for result in results)
+
+        previous = z
+        relaxed = admmRelaxation*local + (1-admmRelaxation)*z
+        z = projectConsensus((relaxed + u).mean(axis=0))
+        u += relaxed - z
+
+        # residuals relative to the liquidity and to the duals rho*u, so
+        # neither depends on the scale of the trades or of the liquidity
+        primal = np.linalg.norm(local - z)/max(np.linalg.norm(local), np.sqrt(K)*np.linalg.norm(z))
+        dual = rho*np.sqrt(K)*np.linalg.norm(z - previous)/max(rho*np.linalg.norm(u), np.finfo(float).tiny)
+        converged = iteration + 1 >= admmMinIterations and primal <= admmTolerance and dual <= admmTolerance
+
+        history.append({
+            'iteration': iteration,
+            'objective': counts @ arrived,
+            'primal': primal,
+            'dual': dual,
+            'rho': rho,
+            'converged': converged
+        })
+        if converged:
+            break
+
+        # keep both relative residuals within a factor of 10, u is scaled by 1/rho
+        if primal > 10*dual:
+            rho *= 2
+            u /= 2
+        elif dual > 10*primal:
+            rho /= 2
+            u *= 2
+
+    if executor is not None:
+        executor.shutdown()
+
+    consensus = cp.Parameter(m, nonneg=True, name='consensus liquidity')
+    consensusObjective, consensusConstraints, consensusVariables = convexModel.buildRouting(graph, consensus, fee, pools=np.flatnonzero(z))
+    consensus.value = z
+    objective, record = solverStrategy.solve(cp.Problem(cp.Maximize(consensusObjective), consensusConstraints), strategy, timeBudget)
+    solverRecords.append(record)
+
+    return z, objective, history
+
+
+
+if __name__ == '__main__':
+    """
+    START SOLVING
+
+    We do a simple gradient descent where we move a 'delta' unit of $$ between
+    the two pools with the best improvement until we plateau.
+
+    """
+
+    liquidity.value = graph.liquidity
+
+    if admm:
+        optimalLiquidity, averageTrade, history = solveADMM()
+    else:
+        averageTrade, record = solverStrategy.solve(prob, strategy, timeBudget)
+        solverRecords.append(record)
+        optimalLiquidity = liquidity.value
+
+    # the weights dictionary is only built for the output
+    weights = graph.weights
+
+    averageInput = 0
+    for token1 in nodes:
+        for token2 in nodes:
+            buckets = weights[token1][token2]['buckets']
+            for bucket in buckets:
+                averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']    
+
+    print('average input:\t', averageInput)
+    print('average trade:\t', averageTrade*totalLiquidity)
+
+    if admm:
+        last = history[-1]
+        print('ADMM iterations:', last['iteration'] + 1, '\tconverged:', last['converged'])
+        print('primal residual:', last['primal'], '\tdual residual:', last['dual'], '\trho:', last['rho'])
+
+    print('solved with:')
+    for description, count in collections.Counter(solverStrategy.describe(record) for record in solverRecords).items():
+        print('\t', count, 'x', description)
+
+    print('tokens:')
+    for node in nodes:
+        print('\t', weights[node]['symb'])
 
-npLiquidity = np.zeros((m,1))
-for i in range(m):
-    npLiquidity[i,0] = scaledLiquidity[edges[i]]
-    
-liquidity.value = npLiquidity
 
-averageTrade = prob.solve(solver='SCS', verbose=False, max_iters=maxIterations, eps=accuracy)
-    
-averageInput = 0
-for token1 in nodes:
-    for token2 in nodes:
-        buckets = weights[token1][token2]['buckets']
-        for bucket in buckets:
-            averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']    
-
-print('average input:\t', averageInput)
-print('average trade:\t', averageTrade*totalLiquidity)
-
-print('tokens:')
-for node in nodes:
-    print('\t', weights[node]['symb'])
-    
-    
 
-plotPools = []
-plotLiq = []
-for (x,y) in scaledLiquidity:
-    if not str((weights[y]['symb'], weights[x]['symb'])) in plotPools:
-        plotPools.append(str((weights[x]['symb'], weights[y]['symb'])))
-        plotLiq.append(scaledLiquidity[(x,y)])
-        
-plt.bar(plotPools, plotLiq)
-plt.xticks(rotation='vertical')
-plt.xlabel('optimal configuration')
-plt.ylabel('level')
+    plotPools = []
+    plotLiq = []
+    for (x,y) in scaledLiquidity:
+        if not str((weights[y]['symb'], weights[x]['symb'])) in plotPools:
+            plotPools.append(str((weights[x]['symb'], weights[y]['symb'])))
+            plotLiq.append(optimalLiquidity[graph.edgeIndex[(x,y)]])
 
+    plt.bar(plotPools, plotLiq)
+    plt.xticks(rotation='vertical')
+    plt.xlabel('optimal configuration')
+    plt.ylabel('level')
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Dual decomposition of the routing problem of convexCalculateTrade.py for
+CPMM pools, in NumPy and SciPy only.
+
+For one (start, goal, bucket) the problem of convexModel.py is: route the
+tradesize from the start token to the goal token through the pools, every
+pool e from token i to token j with liquidity L taking in Delta of token i
+and paying out Lambda of token j with
+    L^2 <= (L + (1-fee)*Delta) * (L - Lambda)
+and maximize the amount arriving at the goal token.
+
+With a price nu_t for every token (nu_goal = 1) the Lagrangian splits into
+one arbitrage problem per pool: maximize nu_j*Lambda - nu_i*Delta. For a
+constant product pool it has the closed form solution
+    Delta = L/(1-fee) * (sqrt((1-fee)*nu_j/nu_i) - 1)
+    Lambda = L * (1 - sqrt(nu_i/((1-fee)*nu_j)))
+    profit = L * (sqrt(nu_j) - sqrt(nu_i/(1-fee)))^2
+if the bracket of the profit is positive and no trade otherwise. The dual
+    nu_start*tradesize + sum over the pools of their profit
+is an upper bound on the arrived amount for any prices and equal to the
+optimum of the convex problem for the best prices. In the variables
+p = sqrt(nu) it is a convex, piecewise quadratic function with a continuous
+gradient, which we minimize with L-BFGS-B. The profits of all pools are one
+vectorized call, no cvxpy expressions are built.
+
+The trades are tiny compared to the pools, so the best prices are almost
+the prices p0 without any trade, (1-fee)^(d/2) for a token d pools away
+from the goal, and only differ from them by about tradesize/L. L-BFGS-B
+therefore works on the offsets q = (p - p0)/sigma with sigma = tradesize/L
+for the mean liquidity L, which keeps the dual well scaled for any size of
+the trades.
+
+"""
+
+import numpy as np
+import scipy.optimize
+import itertools
+
+
+
+# Tolerances of L-BFGS-B on the relative change of the dual and on its gradient
+tolerance = 1e-13
+gradientTolerance = 1e-10
+maxIterations = 10000
+
+
+
+'''
+INPUT:
+    liquidity: array (m,) with the liquidity of every pool
+    sourcePrices, targetPrices: arrays (m,) with the square root of the price
+        of the token going into and coming out of every pool
+    fee: fee for the CPMM
+    gap: added to sqrt(nu_j) - sqrt(nu_i/(1-fee)) of every pool, for prices
+        given as offsets (see route)
+
+OUTPUT:
+    profit: array (m,) with the profit of the best trade in every pool
+    surplus: array (m,) with sqrt(nu_j) - sqrt(nu_i/(1-fee)) + gap where
+        positive and 0 otherwise. The gradient of the profit is 2*L*surplus
+        with respect to targetPrices and -2*L*surplus/sqrt(1-fee) with
+        respect to sourcePrices.
+'''
+def arbitrage(liquidity, sourcePrices, targetPrices, fee=0.003, gap=0):
+    surplus = np.maximum(gap + targetPrices - sourcePrices/np.sqrt(1-fee), 0)
+    return liquidity * surplus**2, surplus
+
+
+
+'''
+INPUT:
+    liquidity: array (m,) with the liquidity of every pool
+    surplus: array (m,) with the surplus of every pool (see arbitrage)
+    sourcePrices, targetPrices: square roots of the prices (see arbitrage)
+    fee: fee for the CPMM
+
+OUTPUT:
+    tendered: array (m,) with the amount Delta put into every pool
+    received: array (m,) with the amount Lambda taken out of every pool
+'''
+def getFlows(liquidity, surplus, sourcePrices, targetPrices, fee=0.003):
+    active = surplus > 0
+
+    tendered = np.zeros(len(liquidity))
+    received = np.zeros(len(liquidity))
+    tendered[active] = liquidity[active] * surplus[active] / (np.sqrt(1-fee) * sourcePrices[active])
+    received[active] = liquidity[active] * surplus[active] / targetPrices[active]
+
+    return tendered, received
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m,) with the liquidity of every pool
+    goal: token id of the goal
+    fee: fee for the CPMM
+
+OUTPUT:
+    prices: array (n,) with the square root of the price of every token
+        without any trade, (1-fee)^(d/2) for a token d pools with liquidity
+        away from the goal and 0 for tokens that can't reach it
+'''
+def getReferencePrices(graph, liquidity, goal, fee=0.003):
+    source = graph.source[liquidity > 0]
+    target = graph.target[liquidity > 0]
+
+    distance = np.full(graph.n, np.inf)
+    distance[goal] = 0
+    for round in range(graph.n - 1):
+        previous = distance.copy()
+        np.minimum.at(distance, source, distance[target] + 1)
+        if (distance == previous).all():
+            break
+
+    reachable = np.isfinite(distance)
+    prices = np.zeros(graph.n)
+    prices[reachable] = np.sqrt(1-fee)**distance[reachable]
+
+    return prices
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m,) with the liquidity of every pool
+    start, goal: token ids of the start and the goal
+    tradesize: amount of the start token to route, scaled like the liquidity
+    fee: fee for the CPMM
+
+OUTPUT:
+    arrived: the optimal amount arriving at the goal, the same as the one of
+        the convex problem of the block
+    prices: array (n,) with the optimal price of every token in units of the
+        goal token
+    flows: (tendered, received) of every pool at the optimal prices
+'''
+def route(graph, liquidity, start, goal, tradesize, fee=0.003):
+    source = graph.source
+    target = graph.target
+    n = graph.n
+    factor = 1/np.sqrt(1-fee)
+
+    reference = getReferencePrices(graph, liquidity, goal, fee)
+    if reference[start] == 0:
+        return 0.0, reference**2, (np.zeros(graph.m), np.zeros(graph.m))
+
+    # offsets q = (p - reference)/sigma, dual = tradesize*(reference[start]^2 + sigma*h(q))
+    scale = liquidity[liquidity > 0].mean()
+    sigma = tradesize/scale
+    weights = liquidity/scale
+    gap = (reference[target] - factor*reference[source])/sigma
+
+    def dual(q):
+        profit, surplus = arbitrage(weights, q[source], q[target], fee, gap)
+        weighted = 2 * weights * surplus
+
+        gradient = np.bincount(target, weighted, n) - factor * np.bincount(source, weighted, n)
+        gradient[start] += 2 * reference[start] + 2 * sigma * q[start]
+
+        return 2 * reference[start] * q[start] + sigma * q[start]**2 + profit.sum(), gradient
+
+    # the goal token is the unit of the prices, all others can't be negative
+    bounds = [(-price/sigma, None) for price in reference]
+    bounds[goal] = (0, 0)
+
+    result = scipy.optimize.minimize(dual, np.zeros(n), jac=True, method='L-BFGS-B', bounds=bounds,
+                                     options={'ftol': tolerance, 'gtol': gradientTolerance, 'maxiter': maxIterations})
+    q = result.x
+    p = reference + sigma*q
+
+    surplus = arbitrage(weights, q[source], q[target], fee, gap)[1]
+    arrived = tradesize * (reference[start]**2 + sigma*result.fun)
+
+    return arrived, p**2, getFlows(liquidity, sigma*surplus, p[source], p[target], fee)
+
+
+
+'''
+INPUT:
+    graph: graph of the config (see graphModel.py)
+    liquidity: array (m,) with the liquidity of every pool
+    fee: fee for the CPMM
+
+OUTPUT:
+    objective: the demand weighted arrived amount of all (start, goal, bucket),
+        the optimal value of the problem of convexCalculateTrade.py
+    arrived: dictionary with the arrived amount of every (start, goal, bucket)
+        with demand
+'''
+def getObjective(graph, liquidity, fee=0.003):
+    objective = 0
+    arrived = {}
+    for start, goal in itertools.permutations(range(graph.n), 2):
+        for b, bucket in enumerate(graph.bucketNames):
+            demand = graph.demand[start, goal, b]
+            if not demand:
+                continue
+
+            blockArrived, prices, flows = route(graph, liquidity, start, goal, graph.tradesizes[b]/graph.totalLiquidity, fee)
+            arrived[(graph.nodes[start], graph.nodes[goal], bucket)] = blockArrived
+            objective += demand * blockArrived
+
+    return objective, arrived
@@ -6,8 +6,15 @@ This is a temporary script file.
 """
 
 import pandas as pd
+import numpy as np
 import pathlib
 import json
+import swapCache
+import binaryConfig
+import concurrent.futures
+import itertools
+import copy
+import os
 
 
 # Token Data
@@ -46,70 +53,303 @@ poolSlice = [
     '0x50D1c9771902476076eCFc8B2A83Ad6b9355a4c9',
     '0x2b591e99afE9f32eAA6214f7B7629768c40Eeb39']
 
+tokenSlice = {}
+for pool in poolSlice:
+    tokenSlice[pool] = tokens[pool]
+
 
 # Pool Data
 pool_path = pathlib.Path('./Berno Daten/dataV2')
 pool_filename = 'poolData.csv'
 pool_file = pathlib.Path(pool_path/pool_filename)
 
-# reserves / price / pool / blockNumber / logIndex
-poolDF = pd.read_csv(pool_file)
+# Windows are converted into a columnar cache on the first read (see swapCache.py)
+cacheWindows = True
+
+# Number of bytes the data read at once may use (per process), None to read
+# whole windows. Windows are then streamed in chunks and only the running
+# weights and reserves are kept. The reserve events kept are bounded by the
+# number of pools times the number of snapshot blocks (see reduceEvents).
+memoryLimit = None
+
+# The vectorized code keeps a few temporary copies of a chunk alive
+chunkOverhead = 4
+
+
+
+'''
+getChunks
+
+INPUT:
+    file: csv file of a window
+    columns: columns to read
+OUTPUT:
+    yields the window in chunks which fit into 'memoryLimit'
+'''
+
+def getChunks(file, columns):
+    chunksize = None
+    if memoryLimit is not None:
+        chunksize = swapCache.chunkRows(file, columns, memoryLimit // chunkOverhead)
+
+    return swapCache.iterWindow(file, columns, chunksize, cacheWindows)
+
+
+
+'''
+getPools
+
+OUTPUT:
+    reserves: dictionary with an entry for every pool in 'poolData.csv' and no
+        reserves yet. Only the columns we need are read, chunk by chunk.
+'''
+
+def getPools():
+    reserves = {}
+    # pool / token0 / token1
+    for chunk in getChunks(pool_file, ['pool', 'token0', 'token1']):
+        for pool, token0, token1 in zip(chunk['pool'], chunk['token0'], chunk['token1']):
+            reserves[pool] = {
+                'reserves': 0,
+                'token0': token0,
+                'token1': token1
+            }
+
+    return reserves
+
+
+
+# Columns of the reserve events and their types
+eventTypes = {
+    'pool': np.int64,
+    'blockNumber': np.int64,
+    'logIndex': np.int64,
+    'reserves': float
+}
+
+
+
+'''
+concatEvents
+
+INPUT:
+    parts: list of dictionaries of arrays 'pool', 'blockNumber', 'logIndex'
+        and 'reserves', possibly empty
+
+OUTPUT:
+    events: one dictionary with the arrays of all parts, empty arrays if
+        there are no parts
+'''
+
+def concatEvents(parts):
+    events = {}
+    for column, dtype in eventTypes.items():
+        events[column] = np.concatenate([np.zeros(0, dtype)] + [np.asarray(part[column], dtype) for part in parts])
+
+    return events
+
+
+
+'''
+reduceEvents
+
+INPUT:
+    events: dictionary of arrays 'pool', 'blockNumber', 'logIndex' and 'reserves'
+    blocks: sorted array of the blocks the reserves will be asked for
+
+OUTPUT:
+    events: only the last event of every pool up to each of the blocks and
+        none after the last one. getReservesAt() gives the same reserves for
+        these blocks as with all events.
+'''
+
+def reduceEvents(events, blocks):
+    segment = np.searchsorted(blocks, events['blockNumber'], side='left')
+    order = np.lexsort((events['logIndex'], events['blockNumber'], segment, events['pool']))
+
+    pool = events['pool'][order]
+    segment = segment[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (pool[1:] != pool[:-1]) | (segment[1:] != segment[:-1])
+
+    keep = np.sort(order[last & (segment < len(blocks))])
+    return {column: events[column][keep] for column in events}
 
 
 
 '''
-getReserves
+getReserveEvents
 
 INPUT: 
     start: Blocknumber. We look through data in blocks [start, start + 100000] per call.
-    reserves: Information on reserves in pool with an activity more recent than block
-        'start + 100000'.
+    pools: index of all pools (the keys of getPools()). Pools are referred to
+        by their position in this index.
+    blocks: sorted array of the blocks the reserves will be asked for, None
+        to keep every event
     
 OUTPUT:
-    reserves: Updated dictionary including information with reserves of pools with
-        an activity more recent than block 'start'
+    events: dictionary of arrays 'pool', 'blockNumber', 'logIndex' and 'reserves'
+        with every reserve update of a known pool in the window. With 'blocks'
+        every chunk is reduced to the events needed for them (see reduceEvents),
+        so the events kept don't grow with the size of the window.
 
 '''
 
-def getReserves(start = 14800000, reserves = False):
+def getReserveEvents(start, pools, blocks=None):
     
     print(start)
-    
-    if not reserves:
-        reserves = {}
-        for index, poolInfo in poolDF.iterrows():
-            reserves[poolInfo['pool']] = {
-                'reserves': 0,
-                'token0': poolInfo['token0'],
-                'token1': poolInfo['token1']
-            }
         
     # Open the reserves info
     reserve_path = pathlib.Path('./Berno Daten/dataV2/reserves')
     reserve_filename = 'reserves' + str(start) + '-' + str(start + 99999) + '.csv'
     reserve_file = pathlib.Path(reserve_path/reserve_filename)
 
+    columns = list(eventTypes)
+    parts = []
+
     # reserves / price / pool / blockNumber / logIndex
-    reservesDF = pd.read_csv(reserve_file)
-    
-    reservesDF.set_index(['pool'], inplace=True)
-    
-    for pool in reserves:
-        if not reserves[pool]['reserves'] and pool in reservesDF.index:
-            reserveHistory = reservesDF.loc[pool]
-                
-            # the exception handels reserves history of length one, as those
-            # are converted directly into float instead of a list?
-            try:
-                reserves[pool]['reserves'] = reserveHistory.reserves.tolist()[0]
-            except TypeError:
-                reserves[pool]['reserves'] = reserveHistory.reserves
-                
-            print('updated pool:', pool, 'with reserves', reserves[pool]['reserves'])
-    
+    for chunk in getChunks(reserve_file, columns):
+        pool = pools.get_indexer(chunk['pool'])
+        known = pool >= 0
+
+        part = {'pool': pool[known]}
+        for column in columns[1:]:
+            part[column] = chunk[column].to_numpy()[known]
+        parts.append(part)
+
+        if blocks is not None:
+            parts = [reduceEvents(concatEvents(parts), blocks)]
+
+    return concatEvents(parts)
+
+
+
+'''
+buildReserveIndex
+
+INPUT:
+    events: list of the events of all windows (see getReserveEvents)
+    pools: index of all pools
+
+OUTPUT:
+    index: all events sorted by (pool, blockNumber, logIndex). The events of
+        pool p are at positions [offsets[p], offsets[p+1]) and 'key' is
+        pool * blockRange + blockNumber, which is sorted as well, so the last
+        event of a pool up to any block is found with one binary search.
+'''
+
+def buildReserveIndex(events, pools):
+    events = concatEvents(events)
+    pool = events['pool']
+    blockNumber = events['blockNumber']
+    logIndex = events['logIndex']
+    reserves = events['reserves']
+
+    order = np.lexsort((logIndex, blockNumber, pool))
+    pool = pool[order]
+    blockNumber = blockNumber[order]
+
+    blockRange = int(blockNumber.max()) + 1 if len(blockNumber) else 1
+
+    return {
+        'pools': pools,
+        'blockRange': blockRange,
+        'key': pool * blockRange + blockNumber,
+        'offsets': np.searchsorted(pool, np.arange(len(pools) + 1)),
+        'reserves': reserves[order]
+    }
+
+
+
+'''
+getReservesAt
+
+INPUT:
+    index: reserve index from buildReserveIndex()
+    block: Blocknumber of the snapshot
+    reserves: reserves dictionary to fill in, a new one from getPools() if False.
+        Pass a copy of getPools() when asking for several blocks, so
+        poolData.csv is only read once.
+
+OUTPUT:
+    reserves: reserves of every pool as of block 'block', that is after the
+        last update of the pool up to and including that block. Pools without
+        an update keep reserves 0.
+'''
+
+def getReservesAt(index, block, reserves = False):
+    if not reserves:
+        reserves = getPools()
+
+    pools = np.arange(len(index['pools']), dtype=np.int64)
+    block = min(block, index['blockRange'] - 1)
+
+    last = np.searchsorted(index['key'], pools * index['blockRange'] + block, side='right') - 1
+    found = last >= index['offsets'][:-1]
+
+    for pool, reserve in zip(index['pools'][found], index['reserves'][last[found]]):
+        reserves[pool]['reserves'] = float(reserve)
+
     return reserves
 
 
+
+'''
+newWeights
+
+OUTPUT:
+    weights: weights dictionary for the tokens in 'tokenSlice' without any trades
+'''
+
+def newWeights():
+    weights = {}
+    for token in tokenSlice:
+        token1 = token.lower()
+        weights[token1] = {
+            'symb': tokenSlice[token]
+        }
+        for token2 in tokenSlice:
+            token2 = token2.lower()
+            weights[token1][token2] = {
+                'totalVol': 0,
+                'buckets' : {
+                    'bucket0': {
+                        'count':    0,
+                        'rangeLow':0,
+                        'rangeUp': 32,
+                        'tradesize':10
+                    },
+                    'bucket1': {
+                        'count':    0,
+                        'rangeLow':32,
+                        'rangeUp': 320,
+                        'tradesize':100
+                    },
+                    'bucket2':  {
+                        'count':    0,
+                        'rangeLow':320,
+                        'rangeUp': 3200,
+                        'tradesize':1000
+                    },
+                    'bucket3':  {
+                        'count':    0,
+                        'rangeLow':3200,
+                        'rangeUp': 32000,
+                        'tradesize':10000
+                    },
+                    'bucket4':  {
+                        'count':    0,
+                        'rangeLow':32000,
+                        'rangeUp': -1,
+                        'tradesize':100000
+                    }
+                }
+            }
+
+    return weights
+
+
+
 '''
 getWeights
         
@@ -125,49 +365,7 @@ OUTPUT:
 def getWeights(start = 14800000, weights = False):
     
     if not weights:
-        weights = {}
-        for token in tokenSlice:
-            token1 = token.lower()
-            weights[token1] = {
-                'symb': tokenSlice[token]
-            }
-            for token2 in tokenSlice:
-                token2 = token2.lower()
-                weights[token1][token2] = {
-                    'totalVol': 0,
-                    'buckets' : {
-                        'bucket0': {
-                            'count':    0,
-                            'rangeLow':0,
-                            'rangeUp': 32,
-                            'tradesize':10
-                        },
-                        'bucket1': {
-                            'count':    0,
-                            'rangeLow':32,
-                            'rangeUp': 320,
-                            'tradesize':100
-                        },
-                        'bucket2':  {
-                            'count':    0,
-                            'rangeLow':320,
-                            'rangeUp': 3200,
-                            'tradesize':1000
-                        },
-                        'bucket3':  {
-                            'count':    0,
-                            'rangeLow':3200,
-                            'rangeUp': 32000,
-                            'tradesize':10000
-                        },
-                        'bucket4':  {
-                            'count':    0,
-                            'rangeLow':32000,
-                            'rangeUp': -1,
-                            'tradesize':100000
-                        }
-                    }
-                }
+        weights = newWeights()
 
     # Open the swap info
     swap_path = pathlib.Path('./Berno Daten/dataV2/volumeData')
@@ -175,63 +373,304 @@ def getWeights(start = 14800000, weights = False):
     swap_file = pathlib.Path(swap_path/swap_filename)
 
     # tradeVol / tokenIn / tokenOut / blockNumber / logIndex / transactionHash
-    df = pd.read_csv(swap_file)
-
-    for index, trade in df.iterrows():
-        tokenIn = trade['tokenIn']
-        tokenOut = trade['tokenOut']
-        tradeVol = trade['tradeVol']
-            
-            
-        if (tokenOut in weights) and (tokenIn in weights):          
-                
-            weights[tokenIn][tokenOut]['totalVol'] += tradeVol
-            
-            buckets = weights[tokenIn][tokenOut]['buckets']
-            for bucket in buckets:
-                if buckets[bucket]['rangeLow'] <= tradeVol and (tradeVol < buckets[bucket]['rangeUp'] or -1 == buckets[bucket]['rangeUp']):
-                    buckets[bucket]['count'] += 1
-                    
+    for chunk in getChunks(swap_file, ['tradeVol', 'tokenIn', 'tokenOut']):
+        weights = addTrades(weights, chunk)
+
     return weights
 
 
 
+'''
+addTrades
+
+INPUT:
+    weights: weights dictionary
+    df: dataframe of trades with the columns tradeVol, tokenIn, tokenOut
+OUTPUT:
+    weights: the weights dictionary with the trades of 'df' counted
+'''
+
+def addTrades(weights, df):
+    # only keep trades between tokens of the slice
+    df = df[df['tokenIn'].isin(list(weights)) & df['tokenOut'].isin(list(weights))]
+
+    # the bucket ranges are the same for every pair, so we take them from any pair
+    token = next(iter(weights))
+    buckets = weights[token][token]['buckets']
+    bucketNames = list(buckets)
+    rangeLow = np.array([buckets[bucket]['rangeLow'] for bucket in bucketNames], dtype=float)
+    rangeUp = np.array([buckets[bucket]['rangeUp'] for bucket in bucketNames], dtype=float)
+    rangeUp[rangeUp == -1] = np.inf
+
+    # assign every trade to the last bucket starting below it and drop trades
+    # which are not below the upper end of that bucket
+    tradeVol = df['tradeVol'].to_numpy(dtype=float)
+    bucketIndex = np.searchsorted(rangeLow, tradeVol, side='right') - 1
+    inBucket = bucketIndex >= 0
+    inBucket[inBucket] = tradeVol[inBucket] < rangeUp[bucketIndex[inBucket]]
+
+    totalVol = df.groupby(['tokenIn', 'tokenOut'], sort=False, observed=True)['tradeVol'].sum()
+    for (tokenIn, tokenOut), vol in totalVol.items():
+        weights[tokenIn][tokenOut]['totalVol'] += vol
+
+    counts = df.assign(bucket=bucketIndex)[inBucket].groupby(['tokenIn', 'tokenOut', 'bucket'], sort=False, observed=True).size()
+    for (tokenIn, tokenOut, bucket), count in counts.items():
+        weights[tokenIn][tokenOut]['buckets'][bucketNames[bucket]]['count'] += int(count)
+
+    return weights
+
+
+
+'''
+getWindow
+
+INPUT:
+    weightBlock: first block of the window we count trades in
+    reserveBlock: first block of the window we look for reserves in
+    pools: index of all pools
+    blocks: blocks the reserves will be asked for (see getReserveEvents)
+
+OUTPUT:
+    weights, events: the partial results of a single pair of windows.
+        The weights go into buildDemandCube(), the reserve events into
+        buildReserveIndex().
+'''
+
+def getWindow(weightBlock, reserveBlock, pools, blocks=None):
+    return getWeights(weightBlock, False), getReserveEvents(reserveBlock, pools, blocks)
+
+
+
+'''
+buildDemandCube
+
+INPUT:
+    start: first block of the first window
+    step: number of blocks per window
+    partials: weights dictionaries of consecutive windows (see getWindow)
+
+OUTPUT:
+    cube: cumulative trade counts and volumes. counts[w] has shape
+        (tokens, tokens, buckets) and holds the counts of windows 0, ..., w-1,
+        volume[w] the same for 'totalVol'. The demand of any range of windows
+        is the difference of two slices (see queryDemand).
+'''
+
+def buildDemandCube(start, step, partials):
+    template = partials[0]
+    tokens = list(template)
+    buckets = list(template[tokens[0]][tokens[0]]['buckets'])
+
+    counts = np.zeros((len(partials) + 1, len(tokens), len(tokens), len(buckets)), dtype=np.int64)
+    volume = np.zeros((len(partials) + 1, len(tokens), len(tokens)))
+
+    for w, weights in enumerate(partials):
+        for i, token1 in enumerate(tokens):
+            for j, token2 in enumerate(tokens):
+                volume[w+1, i, j] = weights[token1][token2]['totalVol']
+                for b, bucket in enumerate(buckets):
+                    counts[w+1, i, j, b] = weights[token1][token2]['buckets'][bucket]['count']
+
+    return {
+        'start': start,
+        'step': step,
+        'template': copy.deepcopy(template),
+        'tokens': tokens,
+        'buckets': buckets,
+        'counts': np.cumsum(counts, axis=0),
+        'volume': np.cumsum(volume, axis=0)
+    }
+
+
+
+'''
+windowIndex
+
+INPUT:
+    cube: demand cube from buildDemandCube()
+    block: start of a window of the cube, or the end of its last window
+
+OUTPUT:
+    w: index of 'block' into the cumulative counts of the cube. Raises
+        ValueError for a block that is not at the start of a window or
+        lies outside the cube.
+'''
+
+def windowIndex(cube, block):
+    w, offset = divmod(block - cube['start'], cube['step'])
+    if offset or not 0 <= w < len(cube['counts']):
+        raise ValueError('block ' + str(block) + ' is not at the start of a window of the demand cube')
+
+    return w
+
+
+
+'''
+queryDemand
+
+INPUT:
+    cube: demand cube from buildDemandCube()
+    first: first block of the range, has to be the start of a window
+    last: end of the range (exclusive), has to be the start of a window
+
+OUTPUT:
+    weights: weights dictionary with the trades between blocks 'first' and 'last'
+'''
+
+def queryDemand(cube, first, last):
+    w1 = windowIndex(cube, first)
+    w2 = windowIndex(cube, last)
+    if w1 > w2:
+        raise ValueError('the range ' + str(first) + '-' + str(last) + ' ends before it starts')
+
+    counts = cube['counts'][w2] - cube['counts'][w1]
+    volume = cube['volume'][w2] - cube['volume'][w1]
+
+    weights = copy.deepcopy(cube['template'])
+    for i, token1 in enumerate(cube['tokens']):
+        for j, token2 in enumerate(cube['tokens']):
+            weights[token1][token2]['totalVol'] = float(volume[i, j])
+            for b, bucket in enumerate(cube['buckets']):
+                weights[token1][token2]['buckets'][bucket]['count'] = int(counts[i, j, b])
+
+    return weights
+
+
+
+'''
+getRollingWeights
+
+INPUT:
+    cube: demand cube from buildDemandCube()
+    length: number of blocks per rolling window, a multiple of the cube's step
+    stride: number of blocks between the starts of two rolling windows, a
+        multiple of the cube's step
+
+OUTPUT:
+    yields (first, last, weights) for every rolling window inside the cube.
+        Raises ValueError if length or stride are no multiples of the step.
+'''
+
+def getRollingWeights(cube, length, stride):
+    if length <= 0 or stride <= 0 or length % cube['step'] or stride % cube['step']:
+        raise ValueError('rolling windows of ' + str(length) + ' blocks every ' + str(stride) + ' blocks do not fit windows of ' + str(cube['step']) + ' blocks')
+
+    end = cube['start'] + (len(cube['counts']) - 1) * cube['step']
+    for first in range(cube['start'], end - length + 1, stride):
+        yield first, first + length, queryDemand(cube, first, first + length)
+
+
+
 '''
 MAIN CODE:
     
 gets weights and reserves for pools between blocks 'start' and 'end' and saves
     the information in the 'config.json' file.
+
+The reserves are taken as of block 'snapshot' from an index over the reserve
+    events. Only the events needed for the snapshot and the ends of the
+    rolling windows are kept, so the index stays small for any amount of data.
+    With 'rolling' set the reserve window at 'start' is read as well, since
+    the first rolling windows end before the other reserve windows begin.
+
+Trade counts are kept per window in a demand cube, so with 'rolling' set
+    a config for every rolling window of that many blocks is written to
+    './configs' as well, without reading the data again.
+
+With workers > 1 every window is read in its own process and the partial
+    results are merged afterwards.
 '''
 
-start = 10100000
-step = 100000
-end = 12800000
+if __name__ == '__main__':
+    start = 10100000
+    step = 100000
+    end = 12800000
 
-weights = False
-reserves= False
-size = len(poolSlice)
-tokenSlice = {}
-for pool in poolSlice:
-    tokenSlice[pool] = tokens[pool]
+    # Number of processes reading windows in parallel
+    workers = 1
 
-for blocks in range(start, end, step):
-    print(blocks)
-    weights = getWeights(blocks, weights)
-    reserves = getReserves(end - (blocks - start), reserves)
-  
-
-filename = 'config.json'
-file = pathlib.Path(filename)
-with open(file, "w") as f:
-    config = {
-        'blocks': {
-            'start': start,
-            'end': end
-        },
-        'size': size,
-        'weights': weights,
-        'reserves': reserves
-    }
-    json.dump(config, f)
-    
-    
\ No newline at end of file
+    # Block of the liquidity snapshot, the end of the last reserve window
+    snapshot = end + step - 1
+
+    # Length and stride in blocks of rolling window configs, None for no rolling configs
+    rolling = None
+    stride = step
+
+    # the rolling configs are cut from whole windows (see getRollingWeights), check before reading the data
+    if rolling and (rolling % step or stride % step):
+        raise ValueError('rolling and stride have to be multiples of step')
+
+    partials = []
+    events = []
+    size = len(poolSlice)
+    poolReserves = getPools()
+    pools = pd.Index(list(poolReserves))
+
+    # blocks the reserves are asked for, the snapshot and the end of every rolling window
+    snapshotBlocks = {snapshot}
+    if rolling:
+        snapshotBlocks.update(first + rolling - 1 for first in range(start, end - rolling + 1, stride))
+    snapshotBlocks = np.array(sorted(snapshotBlocks))
+
+    weightBlocks = list(range(start, end, step))
+    reserveBlocks = [end - (blocks - start) for blocks in weightBlocks]
+
+    # the rolling windows take their reserves from start + rolling - 1 on, so the window at start is read as well
+    extraReserveBlocks = [start] if rolling else []
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for partialWeights, partialEvents in executor.map(getWindow, weightBlocks, reserveBlocks, itertools.repeat(pools), itertools.repeat(snapshotBlocks)):
+                partials.append(partialWeights)
+                events.append(partialEvents)
+            events.extend(executor.map(getReserveEvents, extraReserveBlocks, itertools.repeat(pools), itertools.repeat(snapshotBlocks)))
+
+    else:
+        for blocks, reserveBlock in zip(weightBlocks, reserveBlocks):
+            print(blocks)
+            partials.append(getWeights(blocks, False))
+            events.append(getReserveEvents(reserveBlock, pools, snapshotBlocks))
+        for reserveBlock in extraReserveBlocks:
+            events.append(getReserveEvents(reserveBlock, pools, snapshotBlocks))
+
+    reserveIndex = buildReserveIndex(events, pools)
+    reserves = getReservesAt(reserveIndex, snapshot, copy.deepcopy(poolReserves))
+
+    demandCube = buildDemandCube(start, step, partials)
+    weights = queryDemand(demandCube, start, end)
+      
+
+    filename = 'config.json'
+    file = pathlib.Path(filename)
+    with open(file, "w") as f:
+        config = {
+            'blocks': {
+                'start': start,
+                'end': end
+            },
+            'size': size,
+            'weights': weights,
+            'reserves': reserves
+        }
+        json.dump(config, f)
+    binaryConfig.writeBinaryConfig(config, filename)
+
+    if rolling:
+        rolling_path = pathlib.Path('./configs')
+        if not os.path.exists(rolling_path):
+            os.makedirs(rolling_path)
+
+        for first, last, rollingWeights in getRollingWeights(demandCube, rolling, stride):
+            rolling_filename = 'config' + str(first) + '-' + str(last) + '.json'
+            with open(pathlib.Path(rolling_path/rolling_filename), "w") as f:
+                config = {
+                    'blocks': {
+                        'start': first,
+                        'end': last
+                    },
+                    'size': size,
+                    'weights': rollingWeights,
+                    'reserves': getReservesAt(reserveIndex, last - 1, copy.deepcopy(poolReserves))
+                }
+                json.dump(config, f)
+            binaryConfig.writeBinaryConfig(config, pathlib.Path(rolling_path/rolling_filename))
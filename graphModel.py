@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+The problem data shared by convexCalculateTrade.py, convexOptimizeTrade.py
+and packageRouter.py.
+
+From the config we construct
+    nodes (list)
+    edges (list)
+    currentLiquidity (dict)
+    scaledLiquidity (dict)
+    weights (dict)
+
+and the same information indexed by integers, so that the solvers don't have
+to search through lists:
+    tokenId: token -> id, the position of the token in 'nodes'
+    edgeIndex: (token1, token2) -> id, the position of the pool in 'edges'
+    source, target: token ids of the two tokens of every edge
+    reverse: id of the edge (token2, token1) for every edge (token1, token2)
+    edgeMatrix: (n, n) array with the id of the edge between two tokens, -1 if none
+    indptr, indices, edgeIds: outgoing edges of every token in CSR format.
+        The edges leaving token i go to the tokens indices[indptr[i]:indptr[i+1]]
+        and have the ids edgeIds[indptr[i]:indptr[i+1]].
+
+currentLiquidity dictionary does not have a pool for each pair. The reserves
+    of several pools between the same two tokens are added up.
+scaledLiquidity dicitionary scales values in currentLiquidity dictionary
+    by the totalLiquidity in all pools together.
+
+weights are based on the counted number of trades of a certain size and pair
+    and are normalized by the total number of trades of any size and pair.
+    'demand' and 'tradesizes' hold the same numbers as arrays.
+
+The graph is built from the arrays of the binary config (see binaryConfig.py),
+    memory-mapped if it is up to date. The nested 'weights' dictionary is
+    only built when it is first used, the solvers work on 'demand'.
+
+Graphs are cached per config file and precision, so loading the same config
+twice does not repeat the setup. The graph is shared, don't change it.
+
+"""
+
+import numpy as np
+import itertools
+import functools
+import pathlib
+import os
+import binaryConfig
+
+
+graphs = {}
+
+
+
+class Graph:
+
+    '''
+    INPUT:
+        arrays: arrays of the config (see binaryConfig.loadArrays)
+        precision: number of decimals scaledLiquidity is rounded to
+    '''
+    def __init__(self, arrays, precision):
+        self.precision = precision
+        self.arrays = arrays
+
+        # Construct array of nodes and edges
+        self.nodes = arrays['tokens'].tolist()
+        self.edges = list(itertools.permutations(self.nodes, 2))
+        self.n = len(self.nodes)
+        self.m = len(self.edges)
+
+        self.tokenId = {token: i for i, token in enumerate(self.nodes)}
+        self.edgeIndex = {edge: e for e, edge in enumerate(self.edges)}
+
+        pairs = np.array(list(itertools.permutations(range(self.n), 2)), dtype=np.int64).reshape(-1, 2)
+        self.source = pairs[:, 0]
+        self.target = pairs[:, 1]
+
+        self.edgeMatrix = np.full((self.n, self.n), -1, dtype=np.int64)
+        self.edgeMatrix[self.source, self.target] = np.arange(self.m)
+        self.reverse = self.edgeMatrix[self.target, self.source]
+
+        # CSR adjacency of the outgoing edges
+        order = np.argsort(self.source, kind='stable')
+        self.indptr = np.searchsorted(self.source[order], np.arange(self.n + 1))
+        self.indices = self.target[order]
+        self.edgeIds = order
+
+        # Construct "edge - reserve" dictionary, the reserves of the pools
+        # between the same two tokens are added up in both directions
+        token0 = np.asarray(arrays['edges'][:, 0], dtype=np.int64)
+        token1 = np.asarray(arrays['edges'][:, 1], dtype=np.int64)
+        reserves = np.asarray(arrays['liquidity'], dtype=float)
+        valid = token0 != token1
+
+        # both directions of every pool in the order of the pools, so the sums
+        # are added up in the same order as the reserves in the config
+        rows = np.stack([token0[valid], token1[valid]], axis=1).ravel()
+        columns = np.stack([token1[valid], token0[valid]], axis=1).ravel()
+        pairReserves = np.zeros((self.n, self.n))
+        np.add.at(pairReserves, (rows, columns), np.repeat(reserves[valid], 2))
+        hasPool = np.zeros((self.n, self.n), dtype=bool)
+        hasPool[rows, columns] = True
+
+        self.totalLiquidity = sum(reserves[valid].tolist())
+
+        self.currentLiquidity = {}
+        self.scaledLiquidity = {}
+        for pool, i, j in zip(self.edges, self.source, self.target):
+            if hasPool[i, j]:
+                self.currentLiquidity[pool] = float(pairReserves[i, j])
+                self.scaledLiquidity[pool] = round(self.currentLiquidity[pool]/self.totalLiquidity, precision)
+            else:
+                self.scaledLiquidity[pool] = 0
+
+        self.liquidity = np.array([self.scaledLiquidity[pool] for pool in self.edges], dtype=float)
+        self.totalScaledLiquidity = self.liquidity.sum()
+
+        # Construct weights
+        self.bucketNames = list(arrays['meta']['buckets'])
+        self.bucketId = {bucket: b for b, bucket in enumerate(self.bucketNames)}
+        self.tradesizes = np.array(arrays['tradesizes'], dtype=float)
+        self.buckets = {}
+        for bucket, (rangeLow, rangeUp), tradesize in zip(self.bucketNames, arrays['ranges'].tolist(), self.tradesizes.tolist()):
+            self.buckets[bucket] = {'rangeLow': rangeLow, 'rangeUp': rangeUp, 'tradesize': tradesize}
+
+        # counts are normalized by the number of trades between different tokens
+        counts = np.array(arrays['demand'], dtype=float)
+        self.demand = np.zeros_like(counts)
+        self.demand[self.source, self.target] = counts[self.source, self.target]
+        self.demand /= self.demand.sum()
+
+
+    '''
+    OUTPUT:
+        weights: weights dictionary in the layout of the config, with the
+            counts normalized like 'demand'. Only built when a script asks
+            for it, the solvers use the arrays.
+    '''
+    @functools.cached_property
+    def weights(self):
+        counts = np.array(self.arrays['demand'], dtype=float)
+        counts[self.source, self.target] = self.demand[self.source, self.target]
+        volume = self.arrays['volume']
+
+        weights = {}
+        for i, token1 in enumerate(self.nodes):
+            weights[token1] = {
+                'symb': str(self.arrays['symbols'][i])
+            }
+            for j, token2 in enumerate(self.nodes):
+                weights[token1][token2] = {
+                    'totalVol': float(volume[i, j]),
+                    'buckets': {}
+                }
+                for b, bucket in enumerate(self.bucketNames):
+                    weights[token1][token2]['buckets'][bucket] = dict(self.buckets[bucket], count=float(counts[i, j, b]))
+
+        return weights
+
+
+
+'''
+INPUT:
+    filename: path to the config file
+    precision: number of decimals scaledLiquidity is rounded to
+
+OUTPUT:
+    graph: the graph of the config. It is only constructed again if the
+        config file changed since the last call.
+'''
+def loadGraph(filename='config.json', precision=4):
+    stat = os.stat(filename)
+    key = (str(pathlib.Path(filename).resolve()), stat.st_mtime_ns, stat.st_size, precision)
+
+    if key not in graphs:
+        graphs[key] = Graph(binaryConfig.loadArrays(filename), precision)
+
+    return graphs[key]
@@ -24,76 +24,92 @@ Finally, the 'config.json' file is generated with the 'getConfig.py' file.
 import itertools
 import pathlib
 import matplotlib.pyplot as plt
-import json
-import copy
+import graphModel
+import array
+import hashlib
 import csv
 import os
+import heapq
+import numpy as np
+import batchRouter
+import concurrent.futures
+from multiprocessing import shared_memory
+import collections
+import pickle
 
 
 
 '''
 INPUT: 
-   liquidities: current liquidity levels in the pool graph.
+   liquidities: current liquidity levels in the pool graph. [x, y] of pool e
+       are at positions 2e and 2e+1.
    start: currency offered for trade
    goal: currency traded for
    tradesize: size of the trade
    fee: fee for the CPMM
+   undo: if given, every change of 'liquidities' is appended to this list as
+       (position, old value), so that it can be reverted with rollback()
+   reads: if given, a set the tokens whose pools were read are added to
 
 OUTPUT:
     tradeFromStart[goal]: amount of goal currency received
     liquidities: updated liquidity levels after trading start for goal.
-'''
-def router(liquidities, start, goal, tradesize, fee):
-
-    queue = nodes.copy()
-    k = queue.index(start)
-    queue.insert(0, queue.pop(k))
 
-    tradeFromStart = {}
-    pathFromStart = {}
-    for node in nodes:
-        if node == start:
-            tradeFromStart[node] = tradesize
-            pathFromStart[node] = [start]
-        else:
-            tradeFromStart[node] = 0
-
-    i = 0
-    while i < len(nodes):
-        activeNode = queue[i]
-        for node in nodes:
-            if (activeNode, node) in edges and liquidities[(activeNode, node)][1] and tradeFromStart[activeNode]:
-                x, y = liquidities[(activeNode, node)]
-                dx = tradeFromStart[activeNode]
-                
+The amount only shrinks along a path, so once the goal is taken from the
+    queue its amount and path are final and the search stops there. The
+    result only depends on the pools leaving the tokens in 'reads'.
+'''
+def router(liquidities, start, goal, tradesize, fee, undo=None, reads=None):
+
+    tradeFromStart = dict.fromkeys(nodes, 0)
+    tradeFromStart[start] = tradesize
+    # pool used to reach a node
+    previous = {start: None}
+
+    # the queue is a max-heap on the amount that arrives at a node. Nodes can
+    # be in there several times, only the entry with the current amount counts.
+    queue = [(-tradesize, start)]
+    while queue:
+        amount, activeNode = heapq.heappop(queue)
+        dx = tradeFromStart[activeNode]
+        if -amount < dx:
+            continue
+        if activeNode == goal:
+            break
+        if reads is not None:
+            reads.add(activeNode)
+
+        for node, pool in adjacency[activeNode]:
+            x = liquidities[2*pool]
+            y = liquidities[2*pool+1]
+            if y:
                 dyInv = x/y * 1/(1-fee) * 1/dx + 1/y
                 # check if path s -> activeNode -> node is better than whatever is currently there
                 # also check that the trade (activeNode, node) is not profitable as the
                 #       current algorithm can't handle profitable cycles.
-                if 1/dyInv > tradeFromStart[node] and 1/dyInv < tradeFromStart[activeNode]:
+                if 1/dyInv > tradeFromStart[node] and 1/dyInv < dx:
                     tradeFromStart[node] = 1/dyInv
-                    pathToActive = pathFromStart[activeNode].copy()
-                    pathToActive.append(node)
-                    pathFromStart[node] = pathToActive
-                
-                    j = i+1
-                    k = queue.index(node)
-                    # we could do a binary search between i and k for more efficiency
-                    while(j < len(queue) and tradeFromStart[queue[j]] > tradeFromStart[node]):
-                        j+=1
-
-                    queue.insert(j, queue.pop(k))
-
-        i+=1
+                    previous[node] = pool
+                    heapq.heappush(queue, (-tradeFromStart[node], node))
     
 
-    if goal in pathFromStart:
-        path = pathFromStart[goal]
-        for i in range(len(path)-1):
-            liquidities[(path[i], path[i+1])][0] += (1-fee)*tradeFromStart[path[i]]
-            liquidities[(path[i], path[i+1])][1] -= tradeFromStart[path[i+1]]
-            liquidities[(path[i+1], path[i])][0] -= tradeFromStart[path[i+1]]
-            liquidities[(path[i+1], path[i])][1] += (1-fee)*tradeFromStart[path[i]]
+    if goal in previous:
+        node = goal
+        while previous[node] is not None:
+            pool = previous[node]
+            token = edges[pool][0]
+            back = reverse[pool]
+
+            if undo is not None:
+                for k in (2*pool, 2*pool+1, 2*back, 2*back+1):
+                    undo.append((k, liquidities[k]))
+
+            liquidities[2*pool] += (1-fee)*tradeFromStart[token]
+            liquidities[2*pool+1] -= tradeFromStart[node]
+            liquidities[2*back] -= tradeFromStart[node]
+            liquidities[2*back+1] += (1-fee)*tradeFromStart[token]
+
+            node = token
 
     else:
          tradeFromStart[goal] = 0
@@ -102,35 +118,449 @@ def router(liquidities, start, goal, tradesize, fee):
 
 
 
+'''
+INPUT:
+   liquidities: liquidity levels in the pool graph
+   undo: list of changes as recorded by router()
+
+OUTPUT:
+    liquidities: the liquidity levels before the recorded changes.
+        The undo list is emptied.
+'''
+def rollback(liquidities, undo):
+    for k, value in reversed(undo):
+        liquidities[k] = value
+    undo.clear()
+
+    return liquidities
+
+
+
+'''
+INPUT:
+   liquidities: liquidity levels in the pool graph
+   pool1: id of the pool 'delta' is added to, also added to its reverse
+   pool2: id of the pool 'delta' is taken from, also taken from its reverse
+   undo: list the changes are recorded in (see router)
+
+OUTPUT:
+    liquidities: the liquidity levels after the move, rounded to 'precision'
+'''
+def moveLiquidity(liquidities, pool1, pool2, undo):
+    for pool, change in [(pool1, delta), (reverse[pool1], delta), (pool2, -delta), (reverse[pool2], -delta)]:
+        for k in (2*pool, 2*pool+1):
+            undo.append((k, liquidities[k]))
+            liquidities[k] = round(liquidities[k] + change, precision)
+
+    return liquidities
+
+
+
 '''
 INPUT: 
-   startingLiquidity: For each pair we start routing with this liquidity configuration
+   liquidities: liquidity levels in the pool graph before the trade
+   start: currency offered for trade
+   goal: currency traded for
+   tradesize: size of the whole trade
+   splitInto: the first package has size tradesize/splitInto
+   tolerance: relative error on the arrived amount we accept
+   fee: fee for the CPMM
+   undo: list the changes of 'liquidities' are recorded in (see router)
+   reads: set of the tokens whose pools were read (see router)
+
+OUTPUT:
+    arrivedLiquidity: amount of goal currency received for the whole trade
+    liquidities: updated liquidity levels after the trade
+    packages: number of packages routed
+
+Along a fixed path consecutive swaps add up exactly, since every pool keeps
+    x*y, so the size of the packages only matters where the best path changes
+    within a package and part of it would have been better sent on another
+    path. That loss is less than h/2 times the change of the output rate
+    across a package of size h, which we use as a conservative proxy: after
+    each package the change of the rate (received/size) to the previous
+    package gives that slope, and the next package is sized such that the
+    proxy stays below 'tolerance' times its output. The actual error is
+    usually much smaller, e.g. 4 adaptive packages can arrive at exactly the
+    amount of 5 uniform ones.
+'''
+def routeAdaptive(liquidities, start, goal, tradesize, splitInto, tolerance, fee, undo=None, reads=None):
+    packageSize = tradesize/splitInto
+    minSize = packageSize/maxRefinement
+
+    remaining = tradesize
+    arrivedLiquidity = 0
+    packages = 0
+    previousRate = None
+    previousSize = None
+
+    while remaining > 0:
+        size = min(packageSize, remaining)
+        # don't leave a tiny last package
+        if remaining - size < minSize:
+            size = remaining
+
+        received, liquidities = router(liquidities, start, goal, size, fee, undo, reads)
+        arrivedLiquidity += received
+        remaining -= size
+        packages += 1
+
+        rate = received/size
+        if previousRate is not None:
+            slope = abs(previousRate - rate) / ((previousSize + size)/2)
+            if slope:
+                packageSize = 2*tolerance*rate/slope
+            else:
+                packageSize = 2*size
+            # only change the size by a bounded factor per package
+            packageSize = min(max(packageSize, size/4, minSize), 2*size)
+
+        previousRate = rate
+        previousSize = size
+
+    return arrivedLiquidity, liquidities, packages
+
+
+
+'''
+INPUT: 
+   liquidities: liquidity levels in the pool graph
+   start: currency offered for trade
+   goal: currency traded for
+   bucket, splitInto, fee, tolerance: see getObj()
+   undo: list the changes of 'liquidities' are recorded in (see router)
+   reads: set of the tokens whose pools were read (see router)
+
+OUTPUT:
+    arrivedLiquidity: amount of goal currency received for the trade of the bucket
+    liquidities: liquidity levels after the trade
+    packages: number of packages routed
+'''
+def routePair(liquidities, start, goal, bucket, splitInto, fee, tolerance, undo, reads=None):
+    arrivedLiquidity = 0
+
+    if tolerance is None:
+        tradesize = graph.tradesizes[graph.bucketId[bucket]]/(splitInto*totalLiquidity)
+
+        for i in range(splitInto):
+            received, liquidities = router(liquidities, start, goal, tradesize, fee, undo, reads)
+            arrivedLiquidity += received
+        packages = splitInto
+
+    else:
+        tradesize = graph.tradesizes[graph.bucketId[bucket]]/totalLiquidity
+        arrivedLiquidity, liquidities, packages = routeAdaptive(liquidities, start, goal, tradesize, splitInto, tolerance, fee, undo, reads)
+
+    return arrivedLiquidity, liquidities, packages
+
+
+
+'''
+INPUT: 
+   startingLiquidity: For each pair we start routing with this liquidity configuration.
+       The pairs are routed on it directly and the changes are rolled back
+       after each pair, so it is the same again when getObj returns.
    bucket: Determines the size of trades we are considering (see config)
    splitInto: splitInto many uniform packages are routed sequentially
    fee: fee for the CPMM
+   tolerance: if given, package sizes are chosen adaptively (see routeAdaptive)
+       and 'splitInto' only sets the size of the first package
+   usage: if given, an array with an entry per pool. The squared relative
+       price impact count * (dx/x)**2 of the liquidity dx put into a pool by
+       a pair is added to the entry of the pool (see screenMoves).
+   routes: if given, a dictionary that (arrivedLiquidity, reads) of every
+       (start, goal) is stored in (see getObjIncremental). The pairs are then
+       always routed one by one, also if 'batched' is set.
 
 OUTPUT:
     objective: the average exchange rate between any pair scaled by demand
+    packageCounts[(start, goal, bucket)] holds the number of packages used
+
+Objectives are kept in objectiveCache (see cacheKey). Calls asking for the
+    csv's, usage or routes always route the pairs.
 '''
-def getObj(startingLiquidity, bucket, splitInto, fee=0.003, csv=False):
+def getObj(startingLiquidity, bucket, splitInto, fee=0.003, csv=False, tolerance=None, usage=None, routes=None):
+    key = None
+    if cacheSize and not csv and usage is None and routes is None:
+        key = cacheKey(startingLiquidity, bucket, splitInto, fee, tolerance)
+        if key in objectiveCache:
+            objectiveCache.move_to_end(key)
+            cacheStats['hits'] += 1
+            return objectiveCache[key]
+        cacheStats['misses'] += 1
+
+    if batched and tolerance is None and routes is None:
+        return storeObjective(key, getObjBatched(startingLiquidity, bucket, splitInto, fee, csv, usage))
+
     objective = 0
     # We could use more of the optimal returns
+    routingLiquidity = startingLiquidity
+    undo = []
     for start, goal in itertools.permutations(nodes, 2):
-        routingLiquidity = copy.deepcopy(startingLiquidity)
-        arrivedLiquidity = 0
-        tradesize = weights[start][goal]['buckets'][bucket]['tradesize']/(splitInto*totalLiquidity)
-        
-        for i in range(splitInto):
-            received, routingLiquidity = router(routingLiquidity, start, goal, tradesize, fee)
-            arrivedLiquidity += received
+        reads = set() if routes is not None else None
+        arrivedLiquidity, routingLiquidity, packages = routePair(routingLiquidity, start, goal, bucket, splitInto, fee, tolerance, undo, reads)
+
+        packageCounts[(start, goal, bucket)] = packages
+        if routes is not None:
+            routes[(start, goal)] = (arrivedLiquidity, reads)
         
         if arrivedLiquidity == 0:
             print('explored a disconnected graph.')
             
-        objective += weights[start][goal]['buckets'][bucket]['count'] * arrivedLiquidity
+        count = graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]]
+        objective += count * arrivedLiquidity
+
+        if usage is not None:
+            # the first entry of a position in the undo log is its starting value
+            startingValues = {}
+            for k, value in undo:
+                startingValues.setdefault(k, value)
+            for k, value in startingValues.items():
+                if k % 2 == 0 and routingLiquidity[k] > value:
+                    usage[k//2] += count * ((routingLiquidity[k] - value) / value)**2
+
+        if csv:
+            finalLiquidity = array.array('d', routingLiquidity)
+            rollback(routingLiquidity, undo)
+            getCSV(startingLiquidity, finalLiquidity, start, goal, bucket)
+
+        rollback(routingLiquidity, undo)
+
+    return storeObjective(key, objective)
+
+
+
+'''
+INPUT: 
+   startingLiquidity: liquidity levels to compute the objectives for
+   splitInto, fee, tolerance: see getObj()
+
+OUTPUT:
+    objectives: dictionary with the objective of every bucket, the same as
+        getObj() of the bucket
+    total: the sum of the objectives
+
+The trades of all buckets are routed for a pair before going on to the next
+    pair, and objectives that are in objectiveCache are not computed again.
+    With 'batched' set the pairs of all buckets are routed in one batch.
+'''
+def getObjAll(startingLiquidity, splitInto, fee=0.003, tolerance=None):
+    objectives = {}
+    keys = {}
+    missing = []
+    for bucket in graph.bucketNames:
+        if cacheSize:
+            keys[bucket] = cacheKey(startingLiquidity, bucket, splitInto, fee, tolerance)
+            if keys[bucket] in objectiveCache:
+                objectiveCache.move_to_end(keys[bucket])
+                cacheStats['hits'] += 1
+                objectives[bucket] = objectiveCache[keys[bucket]]
+                continue
+            cacheStats['misses'] += 1
+        missing.append(bucket)
+
+    if missing and batched and tolerance is None:
+        liquidity = np.frombuffer(startingLiquidity).reshape(m, 2)
+        computed, received = batchRouter.getObjectives(graph, liquidity, missing, splitInto, fee)
+        for p, (start, goal) in enumerate(itertools.permutations(nodes, 2)):
+            for i, bucket in enumerate(missing):
+                packageCounts[(start, goal, bucket)] = splitInto
+                if received[i, p] == 0:
+                    print('explored a disconnected graph.')
+        computed = dict(zip(missing, computed))
+
+    elif missing:
+        computed = dict.fromkeys(missing, 0)
+        routingLiquidity = startingLiquidity
+        undo = []
+        for start, goal in itertools.permutations(nodes, 2):
+            for bucket in missing:
+                arrivedLiquidity, routingLiquidity, packages = routePair(routingLiquidity, start, goal, bucket, splitInto, fee, tolerance, undo)
+                packageCounts[(start, goal, bucket)] = packages
+
+                if arrivedLiquidity == 0:
+                    print('explored a disconnected graph.')
+
+                computed[bucket] += graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]] * arrivedLiquidity
+                rollback(routingLiquidity, undo)
+
+    for bucket in missing:
+        objectives[bucket] = storeObjective(keys.get(bucket), computed[bucket])
+
+    objectives = {bucket: objectives[bucket] for bucket in graph.bucketNames}
+    total = 0
+    for bucket in objectives:
+        total += objectives[bucket]
+
+    return objectives, total
+
+
+
+'''
+INPUT: 
+   liquidities: liquidity levels in the pool graph
+   bucket, splitInto, fee, tolerance: see getObj()
+
+OUTPUT:
+    key: hashable key of the objective in objectiveCache. The liquidities
+        are rounded to 'precision' by the descent, so the same configuration
+        always has the same bytes (-0.0 is turned into 0.0). Only a 16 byte
+        digest of them is kept, so a key has the same size for any graph.
+        Adaptive objectives also depend on 'maxRefinement', so it is part
+        of their key.
+'''
+def cacheKey(liquidities, bucket, splitInto, fee, tolerance):
+    pools = hashlib.blake2b((np.frombuffer(liquidities) + 0.0).tobytes(), digest_size=16).digest()
+    refinement = maxRefinement if tolerance is not None else None
+    return (pools, bucket, splitInto, fee, tolerance, refinement)
+
+
+
+'''
+INPUT: 
+   key: key of the objective (see cacheKey), None to not store it
+   objective: objective to store
+
+OUTPUT:
+    objective: the stored objective. Once there are more than 'cacheSize'
+        objectives the least recently used one is removed.
+'''
+def storeObjective(key, objective):
+    if key is not None:
+        objectiveCache[key] = objective
+        objectiveCache.move_to_end(key)
+        while len(objectiveCache) > cacheSize:
+            objectiveCache.popitem(last=False)
+
+    return objective
+
+
+
+'''
+INPUT: 
+   file: file the objectives were saved to with saveCache()
+
+OUTPUT:
+    adds the objectives in the file to objectiveCache if they were computed
+        for the current config file
+'''
+def loadCache(file):
+    if not os.path.exists(file):
+        return
+
+    with open(file, 'rb') as f:
+        saved = pickle.load(f)
+
+    if saved['config'] == configStamp():
+        for key, objective in saved['objectives']:
+            storeObjective(key, objective)
+
+
+
+'''
+INPUT: 
+   file: file to save the objectives to
+
+OUTPUT:
+    saves the objectives in objectiveCache, together with the config file
+        they were computed for (see configStamp)
+'''
+def saveCache(file):
+    with open(file, 'wb') as f:
+        pickle.dump({'config': configStamp(), 'objectives': list(objectiveCache.items())}, f)
 
 
+
+'''
+OUTPUT:
+    stamp: path, mtime and size of the config file and the precision
+'''
+def configStamp():
+    stat = os.stat(filename)
+    return (str(pathlib.Path(filename).resolve()), stat.st_mtime_ns, stat.st_size, precision)
+
+
+
+'''
+INPUT: 
+   startingLiquidity: liquidity levels to compute the objective for
+   bucket, splitInto, fee, tolerance: see getObj()
+   routes: the routes getObj() stored for the same bucket on liquidity levels
+       that only differ from 'startingLiquidity' in the pools 'changed'
+   changed: ids of the pools that changed, with their reverse pools
+
+OUTPUT:
+    objective: the same as getObj() for 'startingLiquidity'
+    rerouted: the routes of the pairs that were routed again. Updating
+        'routes' with them gives the routes of 'startingLiquidity'. None if
+        the objective was taken from objectiveCache, the routes of
+        'startingLiquidity' then have to be computed with getObj().
+
+A pair is only routed again if it read one of the changed pools, all other
+    pairs arrive at the same amount as before. Objectives are kept in
+    objectiveCache like the ones of getObj().
+'''
+def getObjIncremental(startingLiquidity, bucket, splitInto, fee, tolerance, routes, changed):
+    key = None
+    if cacheSize:
+        key = cacheKey(startingLiquidity, bucket, splitInto, fee, tolerance)
+        if key in objectiveCache:
+            objectiveCache.move_to_end(key)
+            cacheStats['hits'] += 1
+            return objectiveCache[key], None
+        cacheStats['misses'] += 1
+
+    changedTokens = set(edges[pool][0] for pool in changed)
+
+    objective = 0
+    rerouted = {}
+    routingLiquidity = startingLiquidity
+    undo = []
+    for start, goal in itertools.permutations(nodes, 2):
+        arrivedLiquidity, reads = routes[(start, goal)]
+
+        if not reads.isdisjoint(changedTokens):
+            reads = set()
+            arrivedLiquidity, routingLiquidity, packages = routePair(routingLiquidity, start, goal, bucket, splitInto, fee, tolerance, undo, reads)
+            rerouted[(start, goal)] = (arrivedLiquidity, reads)
+            rollback(routingLiquidity, undo)
+
+        objective += graph.demand[graph.tokenId[start], graph.tokenId[goal], graph.bucketId[bucket]] * arrivedLiquidity
+
+    return storeObjective(key, objective), rerouted
+
+
+
+'''
+INPUT: 
+   startingLiquidity: For each pair we start routing with this liquidity configuration
+   bucket: Determines the size of trades we are considering (see config)
+   splitInto: splitInto many uniform packages are routed sequentially
+   fee: fee for the CPMM
+   usage: see getObj()
+
+OUTPUT:
+    objective: the same as getObj(), but all pairs are routed at once with
+        array operations (see batchRouter.py)
+'''
+def getObjBatched(startingLiquidity, bucket, splitInto, fee=0.003, csv=False, usage=None):
+    liquidity = np.frombuffer(startingLiquidity).reshape(m, 2)
+    objective, arrived, state = batchRouter.getObjBatched(graph, liquidity, bucket, splitInto, fee)
+
+    if usage is not None:
+        counts = graph.demand[graph.source, graph.target, graph.bucketId[bucket]]
+        inflow = np.maximum(state[:, :, 0] - liquidity[:, 0], 0)
+        x = np.where(inflow > 0, liquidity[:, 0], 1)
+        usage += counts @ (inflow / x)**2
+
+    for p, (start, goal) in enumerate(itertools.permutations(nodes, 2)):
+        packageCounts[(start, goal, bucket)] = splitInto
+
+        if arrived[(start, goal)] == 0:
+            print('explored a disconnected graph.')
+
         if csv:
+            routingLiquidity = array.array('d', state[p].ravel())
             getCSV(startingLiquidity, routingLiquidity, start, goal, bucket)
 
     return objective
@@ -150,13 +580,13 @@ def plotLiquidity(liquidity, weights, name):
     plotPool = []
     plotLiquidity = []
     
-    for (token1, token2) in liquidity:
+    for pool, (token1, token2) in enumerate(edges):
         symb1 = weights[token1]['symb']
         symb2 = weights[token2]['symb']
         
         if not(str((symb1, symb2)) in plotPool or str((symb2, symb1)) in plotPool):
             plotPool.append(str((symb1, symb2)))
-            plotLiquidity.append(liquidity[(token1, token2)][0])
+            plotLiquidity.append(liquidity[2*pool])
 
     plt.bar(plotPool, plotLiquidity)
     plt.xlabel('pools')
@@ -198,6 +628,7 @@ OUTPUT:
         'demand' - scaled count of how many trades of this type there were
 '''
 def getCSV(startingLiquidity, routingLiquidity, start, goal, bucket):
+    weights = graph.weights
     startSymb = weights[start]['symb']
     goalSymb = weights[goal]['symb']
     
@@ -220,12 +651,10 @@ def getCSV(startingLiquidity, routingLiquidity, start, goal, bucket):
         writer = csv.writer(f)
         writer.writerow(header)
     
-        for (token1, token2) in startingLiquidity:
-            pool = (token1, token2)
-            
-            insertedLiquidity = totalLiquidity*(routingLiquidity[pool][0] - startingLiquidity[pool][0])/0.9997
-            removedLiquidity = totalLiquidity*(startingLiquidity[pool][1] - routingLiquidity[pool][1])
-            originalLiquidity = totalLiquidity*startingLiquidity[pool][0]
+        for pool, (token1, token2) in enumerate(edges):
+            insertedLiquidity = totalLiquidity*(routingLiquidity[2*pool] - startingLiquidity[2*pool])/0.9997
+            removedLiquidity = totalLiquidity*(startingLiquidity[2*pool+1] - routingLiquidity[2*pool+1])
+            originalLiquidity = totalLiquidity*startingLiquidity[2*pool]
             demand = weights[token1][token2]['buckets'][bucket]['count']
             
             if insertedLiquidity > 0:
@@ -238,40 +667,135 @@ def getCSV(startingLiquidity, routingLiquidity, start, goal, bucket):
     pass
 
 
+'''
+INPUT:
+   liquidities: liquidity levels in the pool graph
+   usage: price impact absorbed by every pool (see getObj)
+   count: number of moves to return
+
+OUTPUT:
+    moves: the 'count' moves (pool1, pool2) with the largest estimated gain.
+        A move adds 'delta' to pool1 and takes it from pool2, so a pool and
+        its reverse are the same pool here and each move is listed once.
+        The gain of a pool is the price impact absorbed by both its
+        directions: more liquidity helps most where trades move the price.
+        Empty pools carry no trades, so their gain is estimated as 0.
+'''
+def screenMoves(liquidities, usage, count):
+    value = usage + usage[reverse]
+    pools = [pool for pool in range(m) if pool < reverse[pool]]
+
+    moves = []
+    for pool1, pool2 in itertools.permutations(pools, 2):
+        if liquidities[2*pool2]:
+            moves.append((pool1, pool2))
+    moves.sort(key=lambda move: value[move[1]] - value[move[0]])
+
+    return moves[:count]
+
+
+
+'''
+INPUT:
+   name: name of the shared memory block with the liquidities the candidate
+       moves of the descent start from
+
+OUTPUT:
+    attaches a worker process of the descent to the shared memory block
+'''
+def initWorker(name):
+    global sharedMemory, workerRoutes
+    sharedMemory = shared_memory.SharedMemory(name=name)
+    workerRoutes = (None, None)
+
+
+
+'''
+INPUT:
+   liquidities: liquidity levels the move is made on
+   pool1, pool2: the move (see moveLiquidity)
+   undo: list the changes are recorded in (see router)
+   tolerance: relative error on the arrived amount we accept (see getObj)
+   routes: dictionary with the routes of every bucket on 'liquidities' (see
+       getObj), None to route all pairs again
+
+OUTPUT:
+    objective: the objective summed over all buckets after the move
+    rerouted: dictionary with the pairs of every bucket that were routed again
+        (see getObjIncremental), empty without 'routes'
+'''
+def evaluateMove(liquidities, pool1, pool2, undo, tolerance, routes=None):
+    moveLiquidity(liquidities, pool1, pool2, undo)
+    changed = [pool1, reverse[pool1], pool2, reverse[pool2]]
+
+    if routes is None:
+        objectives, objective = getObjAll(liquidities, splitInto, fee, tolerance)
+        return objective, {}
+
+    objective = 0
+    rerouted = {}
+    for bucket in buckets:
+        bucketObjective, rerouted[bucket] = getObjIncremental(liquidities, bucket, splitInto, fee, tolerance, routes[bucket], changed)
+        objective += bucketObjective
+
+    return objective, rerouted
+
+
+
+'''
+INPUT:
+   moves: candidate moves (pool1, pool2) of the descent (see moveLiquidity)
+   tolerance: relative error on the arrived amount we accept (see getObj)
+   version: number of the liquidities in shared memory. With 'incremental'
+       set the routes on them are only computed once per version.
+
+OUTPUT:
+    objectives: the objective summed over all buckets after each of the moves.
+        Every move is made on the liquidities in shared memory (see initWorker),
+        not on the liquidities after the previous move.
+'''
+def evaluateMoves(moves, tolerance, version):
+    global workerRoutes
+    liquidities = array.array('d')
+    liquidities.frombytes(sharedMemory.buf[:16*m])
+
+    routes = None
+    if incremental:
+        if workerRoutes[0] != version:
+            routes = {}
+            for bucket in buckets:
+                routes[bucket] = {}
+                getObj(liquidities, bucket, splitInto, fee, tolerance=tolerance, routes=routes[bucket])
+            workerRoutes = (version, routes)
+        routes = workerRoutes[1]
+
+    undo = []
+    objectives = []
+    for pool1, pool2 in moves:
+        objective, rerouted = evaluateMove(liquidities, pool1, pool2, undo, tolerance, routes)
+        objectives.append(objective)
+        rollback(liquidities, undo)
+
+    return objectives
+
+
+
 """
 PROBLEM DATA:
 
-We grab the basic information from the json file and construct
+The problem data is constructed once per config file in graphModel.py:
     nodes (list)
     edges (list)
     currentLiquidity (dict)
     scaledLiquidity (dict)
-    weights (dict)
+    weights (dict), only built for the output. The objectives use the
+        arrays graph.demand and graph.tradesizes.
 
-currentLiquidity dictionary does not have a pool for each pair.
-scaledLiquidity dicitionary scales values in currentLiquidity dictionary
-    by the totalLiquidity in all pools together.
-    
-weights are based on the counted number of trades of a certain size and pair
-    and are normalized by the total number of trades of any size and pair
+The router works on liquidities of the form [x, y] per pool. They are kept
+    in one flat float array with [x, y] of pool e at positions 2e and 2e+1.
 """
 
 filename = 'config.json'
-file = pathlib.Path(filename)
-
-text = open(filename)
-config = json.load(text)
-    
-n = config['size']
-weights = config['weights']
-reserves = config['reserves']
-
-
-# Construct the rest of the problemdata
-nodes = []
-edges = []
-currentLiquidity = {}
-scaledLiquidity = {}
 
 # Precision is used for rouding scaled liquidity and gradient descent stepsize
 precision = 2
@@ -282,139 +806,233 @@ fee = 0.003
 # Split into is how many uniform packages we split trades into
 splitInto = 500
 
+# Relative tolerance on the arrived amount for adaptive package sizes,
+# None to always route splitInto uniform packages
+tolerance = None
 
-# Construct array of nodes and edges
-for token1, token2 in itertools.permutations(weights, 2):
-    nodes.append(token1)
-    nodes.append(token2)
-    edges.append((token1, token2))
+# Route the packages of all pairs at once with array operations (see batchRouter.py)
+batched = False
 
-nodes = list(set(nodes))
+# Adaptive packages are at least 1/maxRefinement of the first package
+maxRefinement = 16
 
+# Number of packages getObj used for each (start, goal, bucket)
+packageCounts = {}
 
-# Construct "edge - reserve" dictionary
-totalLiquidity = 0
-for pool in reserves:
-    try:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])][0] += reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])][1] += reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])][0] += reserves[pool]['reserves']
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])][1] += reserves[pool]['reserves']
-    except KeyError:
-        currentLiquidity[(reserves[pool]['token0'], reserves[pool]['token1'])] = [reserves[pool]['reserves'], reserves[pool]['reserves']]
-        currentLiquidity[(reserves[pool]['token1'], reserves[pool]['token0'])] = [reserves[pool]['reserves'], reserves[pool]['reserves']]
+# Liquidity moved between two pools in one step of the descent
+delta = 1/(10**precision)
 
-    if (reserves[pool]['token0'], reserves[pool]['token1']) in edges:
-        totalLiquidity += reserves[pool]['reserves']
+# Number of processes evaluating candidate moves of the descent in parallel
+workers = 1
 
+# Number of candidate moves a process evaluates per task
+movesPerTask = 4
 
-for pool in edges:
-    if pool in currentLiquidity:
-        scaledLiquidity[pool] = [round(currentLiquidity[pool][0]/totalLiquidity, precision), round(currentLiquidity[pool][1]/totalLiquidity, precision)]
-    else:
-        scaledLiquidity[pool] = [0, 0]
+# Number of candidate moves evaluated per sweep of the descent, chosen by the
+# price impact of the pools (see screenMoves). None to evaluate all moves.
+topMoves = None
 
+# Only route the pairs again that read a pool changed by a move (see getObjIncremental).
+# On small dense graphs almost every pair reads the changed pools.
+incremental = False
 
-# Construct weights
-totTrades = 0
-for token1, token2 in itertools.permutations(nodes, 2):
-    buckets = weights[token1][token2]['buckets']
-    for bucket in buckets:
-        totTrades += buckets[bucket]['count']
-            
-for token1, token2 in itertools.permutations(nodes, 2):
-    for bucket in buckets:
-        weights[token1][token2]['buckets'][bucket]['count'] /= totTrades
-    
+# Number of objectives kept in objectiveCache, 0 to not cache objectives
+cacheSize = 10000
 
+# File objectiveCache is saved to after the descent and loaded from before it, None to not save it
+cacheFile = None
 
-"""
-START SOLVING
+# Objectives of liquidity configurations by cacheKey(), least recently used first
+objectiveCache = collections.OrderedDict()
+cacheStats = {'hits': 0, 'misses': 0}
 
-We do a simple gradient descent where we move a 'delta' unit of $$ between
-the two pools with the best improvement until we plateau.
+graph = graphModel.loadGraph(filename, precision)
 
-"""
+nodes = graph.nodes
+edges = graph.edges
+currentLiquidity = graph.currentLiquidity
+buckets = graph.buckets
+totalLiquidity = graph.totalLiquidity
 
-delta = 1/(10**precision)
-steps = 0
+m = graph.m
+reverse = graph.reverse.tolist()
 
-currentObjectives = []
-for bucket in buckets:
-    currentObjectives.append(getObj(scaledLiquidity, bucket, splitInto, fee))
-currentObjective = sum(currentObjectives)
-scaledObjective = currentObjective
-bestObjective = currentObjective
-bestLiquidity = scaledLiquidity.copy()
+scaledLiquidity = array.array('d', np.repeat(graph.liquidity, 2))
 
-while bestObjective > currentObjective or steps == 0:
-    
-    currentObjective = bestObjective
-    bestObjective = 0
+# Outgoing pools of every token as (token, pool id) from the CSR adjacency of the graph
+adjacency = {}
+for i, token in enumerate(nodes):
+    adjacency[token] = []
+    for k in range(graph.indptr[i], graph.indptr[i+1]):
+        adjacency[token].append((nodes[graph.indices[k]], int(graph.edgeIds[k])))
 
-    for (pool1, pool2) in itertools.permutations(edges, 2):
-        liquidity = bestLiquidity.copy()
-        (token11, token12) = pool1
-        (token21, token22) = pool2
-        
-        # it might be more efficient to move as soon as there is improvement?
-        # we don't have to consider all swaps, its enough to condier swaps (i, i+1)
-        if liquidity[pool2][0]:
-            liquidity[pool1] = [round(liquidity[pool1][0] + delta, precision), round(liquidity[pool1][1] + delta, precision)]
-            liquidity[(token12, token11)] = [round(liquidity[(token12, token11)][0] + delta, precision), round(liquidity[(token12, token11)][1] + delta, precision)]
-            liquidity[pool2] = [round(liquidity[pool2][0] - delta, precision), round(liquidity[pool2][1] - delta, precision)]
-            liquidity[(token22, token21)] = [round(liquidity[(token22, token21)][0] - delta, precision), round(liquidity[(token22, token21)][1] - delta, precision)]
-
-            objectives = []
-            for bucket in buckets:
-                objectives.append(getObj(liquidity, bucket, splitInto, fee))
-            objective = sum(objectives)
-            
-            if objective > max(currentObjective, bestObjective):
-                bestObjective = objective
-                bestLiquidity = liquidity.copy()
-    steps += 1
 
 
+if __name__ == '__main__':
+    """
+    START SOLVING
 
-"""
-OUTPUT
+    We do a simple gradient descent where we move a 'delta' unit of $$ between
+    the two pools with the best improvement until we plateau.
 
-We plot some things such as:
-    -optimal and current routing
-    -optimal and current liquidity
+    With 'topMoves' set, every sweep first routes the current liquidities once
+    and only evaluates the moves with the largest estimated gain (see screenMoves).
 
+    """
 
-"""
+    steps = 0
+
+    if cacheFile is not None:
+        loadCache(cacheFile)
 
-# Calculate the average amount of tokens traded for reference
-averageInput = 0
-for token1 in nodes:
-    for token2 in nodes:
-        buckets = weights[token1][token2]['buckets']
+    # routes of every bucket on bestLiquidity for the incremental evaluation
+    routes = None
+    if incremental:
+        routes = {bucket: {} for bucket in buckets}
+
+    if incremental:
+        currentObjective = 0
         for bucket in buckets:
-            averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']
-            
+            currentObjective += getObj(scaledLiquidity, bucket, splitInto, fee, tolerance=tolerance, routes=routes[bucket])
+    else:
+        currentObjectives, currentObjective = getObjAll(scaledLiquidity, splitInto, fee, tolerance)
+    scaledObjective = currentObjective
+    bestObjective = currentObjective
+    bestLiquidity = array.array('d', scaledLiquidity)
 
-# Save some routings to look at
-for bucket in buckets:
-    getObj(scaledLiquidity, bucket, splitInto, fee, csv=True)
-    getObj(bestLiquidity, bucket, splitInto, fee, csv=True)
+    # released in the finally block below, also if the descent fails
+    executor = None
+    sharedMemory = None
 
-plotLiquidity(scaledLiquidity, weights, 'current')
-plotLiquidity(bestLiquidity, weights, 'best')
+    try:
+        if workers > 1:
+            # the processes read the liquidities the candidate moves start from here
+            sharedMemory = shared_memory.SharedMemory(create=True, size=bestLiquidity.itemsize*len(bestLiquidity))
+            sharedLiquidity = np.ndarray(len(bestLiquidity), dtype=float, buffer=sharedMemory.buf)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(sharedMemory.name,))
+            version = 0
+
+        while bestObjective > currentObjective or steps == 0:
+
+            currentObjective = bestObjective
+            bestObjective = 0
+
+            moves = list(itertools.permutations(range(m), 2))
+            if topMoves is not None:
+                usage = np.zeros(m)
+                for bucket in buckets:
+                    getObj(bestLiquidity, bucket, splitInto, fee, tolerance=tolerance, usage=usage)
+                moves = screenMoves(bestLiquidity, usage, topMoves)
+
+            if workers > 1:
+                # The moves are evaluated in batches on the same liquidities, in the
+                # order of the serial loop below. The first improving move of a batch
+                # is made and the next batch starts after it, so the moves made are
+                # the same as in the serial loop.
+                position = 0
+                while position < len(moves):
+                    sharedLiquidity[:] = bestLiquidity
+                    batch = [k for k in range(position, min(position + workers*movesPerTask, len(moves))) if bestLiquidity[2*moves[k][1]]]
+                    tasks = [[moves[k] for k in batch[i:i + movesPerTask]] for i in range(0, len(batch), movesPerTask)]
+
+                    objectives = []
+                    for taskObjectives in executor.map(evaluateMoves, tasks, itertools.repeat(tolerance), itertools.repeat(version)):
+                        objectives += taskObjectives
+
+                    position += workers*movesPerTask
+                    for k, objective in zip(batch, objectives):
+                        if objective > max(currentObjective, bestObjective):
+                            bestObjective = objective
+                            moveLiquidity(bestLiquidity, moves[k][0], moves[k][1], [])
+                            position = k + 1
+                            version += 1
+                            break
 
+            else:
+                # moves are made on bestLiquidity directly and rolled back if they don't improve
+                undo = []
+                for (pool1, pool2) in moves:
+
+                    # it might be more efficient to move as soon as there is improvement?
+                    # we don't have to consider all swaps, its enough to condier swaps (i, i+1)
+                    if bestLiquidity[2*pool2]:
+                        objective, rerouted = evaluateMove(bestLiquidity, pool1, pool2, undo, tolerance, routes)
+
+                        if objective > max(currentObjective, bestObjective):
+                            bestObjective = objective
+                            undo.clear()
+                            for bucket in rerouted:
+                                if rerouted[bucket] is None:
+                                    # the objective came from the cache, route the pairs of the new liquidities
+                                    getObj(bestLiquidity, bucket, splitInto, fee, tolerance=tolerance, routes=routes[bucket])
+                                else:
+                                    routes[bucket].update(rerouted[bucket])
+                        else:
+                            rollback(bestLiquidity, undo)
+            steps += 1
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if sharedMemory is not None:
+            sharedMemory.close()
+            sharedMemory.unlink()
+
+    if cacheFile is not None:
+        saveCache(cacheFile)
+
+
+
+    """
+    OUTPUT
+
+    We plot some things such as:
+        -optimal and current routing
+        -optimal and current liquidity
+
+
+    """
+
+    # the weights dictionary is only built here, the processes of the descent use graph.demand
+    weights = graph.weights
+
+    # Calculate the average amount of tokens traded for reference
+    averageInput = 0
+    for token1 in nodes:
+        for token2 in nodes:
+            buckets = weights[token1][token2]['buckets']
+            for bucket in buckets:
+                averageInput += buckets[bucket]['count'] * buckets[bucket]['tradesize']
 
-print('average input:', averageInput)
 
-print('old:\t', totalLiquidity * scaledObjective)
-print('opt:\t', totalLiquidity * currentObjective, end='\n\n')
+    # Save some routings to look at
+    for bucket in buckets:
+        getObj(scaledLiquidity, bucket, splitInto, fee, csv=True, tolerance=tolerance)
+        getObj(bestLiquidity, bucket, splitInto, fee, csv=True, tolerance=tolerance)
 
-print('steps:\t\t', steps)
-print('precision:\t', precision, end='\n\n')
-print('split into', splitInto, 'trades')
+    plotLiquidity(scaledLiquidity, weights, 'current')
+    plotLiquidity(bestLiquidity, weights, 'best')
 
-print('tokens:')
-for node in nodes:
-    print('\t', weights[node]['symb'])
 
+    print('average input:', averageInput)
+
+    print('old:\t', totalLiquidity * scaledObjective)
+    print('opt:\t', totalLiquidity * currentObjective, end='\n\n')
+
+    print('steps:\t\t', steps)
+    print('precision:\t', precision, end='\n\n')
+    print('split into', splitInto, 'trades')
+
+    if tolerance is not None:
+        # packageCounts holds the counts of the last evaluation, the best liquidity
+        print('adaptive packages with tolerance', tolerance, 'instead of', splitInto, 'per trade:')
+        for start, goal in itertools.permutations(nodes, 2):
+            counts = [packageCounts[(start, goal, bucket)] for bucket in buckets]
+            print('\t', weights[start]['symb'], '->', weights[goal]['symb'], counts)
+
+    # with workers > 1 most objectives are computed in the worker processes
+    print('objective cache:', cacheStats['hits'], 'hits,', cacheStats['misses'], 'misses')
+
+    print('tokens:')
+    for node in nodes:
+        print('\t', weights[node]['symb'])
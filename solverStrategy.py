@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Solver strategies for the convex problems of convexCalculateTrade.py and
+convexOptimizeTrade.py.
+
+The trades are tiny compared to the pools, so the problems are badly scaled.
+The interior point solver Clarabel reaches its default tolerances in a few
+dozen iterations, while SCS at 1e-4 can still be far off the optimum and
+report it as optimal.
+
+A strategy is a list of attempts, each a conic solver with its options and
+the relative error of the objective we measured against dualRouter.py on
+the synthetic instances (see benchmark.py) when the attempt ends optimal:
+    fast: Clarabel with a looser relative gap, within about 1%
+    production: Clarabel with its default tolerances, within about 1e-3,
+        then SCS to 1e-8 if Clarabel fails
+    reference: SCS to 1e-8 with up to 10^7 iterations as the scripts always
+        did, then Clarabel with tight tolerances
+
+solve() goes through the attempts until one reaches an optimal status, or
+until no later attempt can be more accurate than a result it has. Each
+attempt gets the part of the wall-clock budget that is left, less a share
+'fallbackReserve' of the budget kept for every attempt after it, so a first
+attempt that runs out of time still leaves time for the fallbacks. An attempt
+that runs out of time, stops at its iteration limit or fails moves on to the
+next one. The results are ranked by the accuracy of their attempt first and
+by their status second, so an inaccurate result of a tight attempt is
+returned rather than an optimal one of a looser attempt.
+
+Every solve returns a record with the solver, options and status of the
+attempt that produced the result and of all attempts before it.
+
+"""
+
+import cvxpy as cp
+import time
+
+
+
+# cvxpy keeps the settings of Clarabel between solves of the same problem,
+# so every Clarabel attempt sets all of its tolerances
+strategies = {
+    'fast': [
+        {'solver': 'CLARABEL', 'accuracy': 1e-2, 'tol_gap_abs': 1e-12, 'tol_gap_rel': 1e-6, 'tol_feas': 1e-8}
+    ],
+    'production': [
+        {'solver': 'CLARABEL', 'accuracy': 1e-3, 'tol_gap_abs': 1e-8, 'tol_gap_rel': 1e-8, 'tol_feas': 1e-8},
+        {'solver': 'SCS', 'accuracy': 1e-2, 'eps': 1e-8, 'max_iters': 1000000}
+    ],
+    'reference': [
+        {'solver': 'SCS', 'accuracy': 1e-3, 'eps': 1e-8, 'max_iters': 10000000},
+        {'solver': 'CLARABEL', 'accuracy': 1e-3, 'tol_gap_abs': 1e-10, 'tol_gap_rel': 1e-10, 'tol_feas': 1e-10}
+    ]
+}
+
+# Name of the option for the wall-clock limit in seconds of every solver
+timeLimits = {
+    'SCS': 'time_limit_secs',
+    'CLARABEL': 'time_limit'
+}
+
+# Share of the budget kept back for every later attempt of a strategy
+fallbackReserve = 0.2
+
+
+
+'''
+INPUT:
+    problem: cvxpy problem
+    strategy: name of the strategy in 'strategies'
+    budget: wall-clock budget in seconds of all attempts together, None for no limit
+    options: further options for every attempt, e.g. warm_start
+
+OUTPUT:
+    value: optimal value of the problem, the variables hold the solution
+    record: dictionary with the 'strategy', 'solver', 'options', 'status'
+        and 'time' of the attempt that produced the value and the list of
+        all 'attempts' made
+'''
+def solve(problem, strategy='reference', budget=None, **options):
+    installed = cp.installed_solvers()
+    started = time.time()
+    attempts = []
+    best = None
+
+    plan = [dict(attempt) for attempt in strategies[strategy] if attempt['solver'] in installed]
+
+    for a, attempt in enumerate(plan):
+        solver = attempt.pop('solver')
+        accuracy = attempt.pop('accuracy')
+
+        if budget is not None:
+            remaining = budget - (time.time() - started)
+            if remaining <= 0:
+                break
+
+            # keep a share of the budget for the later attempts, if less than
+            # that is left it is split evenly between them
+            later = len(plan) - a - 1
+            limit = remaining - fallbackReserve*budget*later
+            if limit <= 0:
+                limit = remaining/(later + 1)
+            if solver in timeLimits:
+                attempt[timeLimits[solver]] = limit
+
+        attemptStarted = time.time()
+        try:
+            value = problem.solve(solver=solver, verbose=False, **attempt, **options)
+            status = problem.status
+        except cp.error.SolverError:
+            value = None
+            status = 'solver_error'
+
+        result = {
+            'solver': solver,
+            'options': attempt,
+            'status': status,
+            'time': time.time() - attemptStarted
+        }
+        attempts.append(result)
+
+        if status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            continue
+
+        # a looser attempt does not replace a more accurate result, whatever its status
+        rank = (accuracy, status != cp.OPTIMAL)
+        if best is None or rank < best[0]:
+            best = (rank, value, result, {v: v.value for v in problem.variables()})
+
+        # no later attempt can be more accurate than the result kept
+        if status == cp.OPTIMAL or all(later['accuracy'] > best[0][0] for later in plan[a+1:]):
+            break
+
+    if best is None:
+        raise cp.error.SolverError('no solver of the ' + strategy + ' strategy solved the problem: ' + str(attempts))
+
+    # the variables hold the solution of the result returned
+    rank, value, result, solution = best
+    for variable in solution:
+        variable.value = solution[variable]
+
+    return value, dict(result, strategy=strategy, attempts=attempts)
+
+
+
+'''
+INPUT:
+    record: record of a solve (see solve)
+
+OUTPUT:
+    description: solver, options and status of the attempt that produced the result
+'''
+def describe(record):
+    options = ', '.join(key + '=' + str(value) for key, value in record['options'].items() if key not in timeLimits.values())
+    return record['solver'] + ' (' + options + '): ' + record['status']
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+The swap and reserve data comes in csv files of 100000 blocks each.
+Parsing those files from text is what makes getConfig.py slow, so the first
+time a window is read we convert it into a columnar cache next to the csv:
+
+    <csv folder>/cache/<csv name>/
+        meta.json               source mtime and size, dtypes of the columns
+        <column>.bin            numeric columns as raw arrays
+        <column>.codes.bin      text columns as integer codes
+        <column>.values.npy     the distinct strings the codes point to
+
+Only the columns that are asked for are cached, further columns are added
+when they are first needed. The cache is written chunk by chunk, so building
+it needs no more memory than reading the window in chunks.
+
+Numeric columns and codes are loaded memory-mapped, so reading a cached
+window only touches the pages of the columns that are actually used.
+The cache is rebuilt whenever mtime or size of the csv file change.
+
+"""
+
+import pandas as pd
+import numpy as np
+import pathlib
+import json
+import os
+import shutil
+
+
+
+# Version of the cache layout, caches of other versions are rebuilt
+cacheVersion = 2
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+
+OUTPUT:
+    directory: folder holding the cached columns of that file
+'''
+def cacheDirectory(file):
+    file = pathlib.Path(file)
+    return pathlib.Path(file.parent/'cache'/file.stem)
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+
+OUTPUT:
+    meta: contents of meta.json if there is a cache for the file which was
+        built from the current version of the file (same mtime and size),
+        None otherwise.
+'''
+def readMeta(file):
+    metaFile = pathlib.Path(cacheDirectory(file)/'meta.json')
+    if not os.path.exists(metaFile):
+        return None
+
+    with open(metaFile) as f:
+        meta = json.load(f)
+
+    stat = os.stat(file)
+    if meta.get('version') != cacheVersion or meta['mtime'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+        return None
+
+    return meta
+
+
+
+'''
+INPUT:
+    path: raw array file
+    dtype, newDtype: dtype of the array in the file and the one to convert to
+    chunksize: number of values converted at once, None for all at once
+
+OUTPUT:
+    rewrites the file with the values converted to 'newDtype'
+'''
+def promoteFile(path, dtype, newDtype, chunksize=None):
+    rows = os.path.getsize(path) // np.dtype(dtype).itemsize
+    chunksize = chunksize or max(rows, 1)
+    part = pathlib.Path(str(path) + '.part')
+
+    with open(part, 'wb') as f:
+        if rows:
+            values = np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+            for first in range(0, rows, chunksize):
+                values[first:first + chunksize].astype(newDtype).tofile(f)
+            del values
+
+    os.replace(part, path)
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+    columns: list of the columns to cache, None for all columns
+    chunksize: number of rows parsed at once, None for the whole window
+
+OUTPUT:
+    writes the columns into the columnar cache of the file, keeping the
+        columns already cached from the current version of the file.
+        meta.json is written last so a cache interrupted while writing is
+        never considered valid.
+'''
+def writeCache(file, columns=None, chunksize=None):
+    directory = cacheDirectory(file)
+    meta = readMeta(file)
+
+    if meta is None:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+        stat = os.stat(file)
+        meta = {
+            'version': cacheVersion,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'rows': None,
+            'columns': {}
+        }
+
+    else:
+        # meta.json is written again once the new columns are complete
+        os.remove(pathlib.Path(directory/'meta.json'))
+
+    if columns is None:
+        columns = list(pd.read_csv(file, nrows=0).columns)
+    columns = [column for column in columns if column not in meta['columns']]
+
+    rows = 0
+    dtypes = {}
+    uniques = {}
+
+    if chunksize is None:
+        reader = [pd.read_csv(file, usecols=columns)]
+    else:
+        reader = pd.read_csv(file, usecols=columns, chunksize=chunksize)
+
+    for chunk in reader:
+        rows += len(chunk)
+        for column in columns:
+            values = chunk[column]
+            if column not in dtypes:
+                dtypes[column] = values.dtype if pd.api.types.is_numeric_dtype(values) else None
+                uniques[column] = {}
+
+            if dtypes[column] is not None:
+                path = pathlib.Path(directory/(column + '.bin'))
+                dtype = np.result_type(dtypes[column], values.dtype)
+                if dtype != dtypes[column]:
+                    promoteFile(path, dtypes[column], dtype, chunksize)
+                    dtypes[column] = dtype
+                with open(path, 'ab') as f:
+                    values.to_numpy(dtype=dtype).tofile(f)
+
+            else:
+                # codes of the chunk point into its own uniques, map them to the ones of the window
+                codes, chunkUniques = pd.factorize(values)
+                known = uniques[column]
+                mapping = np.array([known.setdefault(value, len(known)) for value in chunkUniques], dtype=np.int32)
+                codes = np.where(codes >= 0, mapping[codes] if len(mapping) else codes, -1).astype(np.int32)
+                with open(pathlib.Path(directory/(column + '.codes.bin')), 'ab') as f:
+                    codes.tofile(f)
+
+    for column in columns:
+        # a window without rows has no chunk to take the dtype from
+        dtypes.setdefault(column, np.dtype(np.float64))
+        if dtypes[column] is not None:
+            meta['columns'][column] = {'kind': 'numeric', 'dtype': np.dtype(dtypes[column]).str}
+        else:
+            np.save(pathlib.Path(directory/(column + '.values.npy')), np.asarray(list(uniques[column]), dtype=str))
+            meta['columns'][column] = {'kind': 'text', 'dtype': np.dtype(np.int32).str}
+
+    if columns:
+        meta['rows'] = rows
+
+    with open(pathlib.Path(directory/'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+
+'''
+INPUT:
+    path: raw array file
+    dtype: dtype of the array
+    rows: number of values in the file
+
+OUTPUT:
+    values: the array memory-mapped read-only
+'''
+def mapFile(path, dtype, rows):
+    if rows == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+    columns: list of the columns needed, None for all columns
+    chunksize: number of rows parsed at once when the cache has to be
+        written, None for the whole window
+
+OUTPUT:
+    rows: number of rows in the window
+    data: dictionary of memory-mapped arrays. Text columns are given as a
+        tuple (codes, values).
+'''
+def loadColumns(file, columns=None, chunksize=None):
+    if columns is None:
+        columns = list(pd.read_csv(file, nrows=0).columns)
+
+    meta = readMeta(file)
+    if meta is None or any(column not in meta['columns'] for column in columns):
+        writeCache(file, columns, chunksize)
+        meta = readMeta(file)
+
+    directory = cacheDirectory(file)
+    rows = meta['rows']
+
+    data = {}
+    for column in columns:
+        info = meta['columns'][column]
+        if info['kind'] == 'numeric':
+            data[column] = mapFile(pathlib.Path(directory/(column + '.bin')), info['dtype'], rows)
+        else:
+            codes = mapFile(pathlib.Path(directory/(column + '.codes.bin')), info['dtype'], rows)
+            values = np.load(pathlib.Path(directory/(column + '.values.npy'))).astype(object)
+            data[column] = (codes, values)
+
+    return rows, data
+
+
+
+'''
+INPUT:
+    data: columns as returned by loadColumns()
+    first, last: the rows [first, last) to put into the dataframe
+
+OUTPUT:
+    df: dataframe of the rows, text columns are categoricals.
+'''
+def toFrame(data, first, last):
+    frame = {}
+    for column in data:
+        if isinstance(data[column], tuple):
+            codes, values = data[column]
+            frame[column] = pd.Categorical.from_codes(codes[first:last], categories=values)
+        else:
+            frame[column] = data[column][first:last]
+
+    return pd.DataFrame(frame, copy=False)
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+    columns: list of the columns needed, None for all columns
+    cache: if False the csv file is parsed directly
+
+OUTPUT:
+    df: dataframe of the window. Numeric columns are memory-mapped from the
+        cache, text columns are categoricals.
+'''
+def readWindow(file, columns=None, cache=True):
+    if not cache:
+        return pd.read_csv(file, usecols=columns)
+
+    rows, data = loadColumns(file, columns)
+    return toFrame(data, 0, rows)
+
+
+
+'''
+INPUT:
+    file: path to the csv file of a block window
+    columns: list of the columns needed, None for all columns
+    chunksize: number of rows per chunk, None for the whole window at once
+    cache: if False the csv file is parsed directly
+
+OUTPUT:
+    yields dataframes of at most 'chunksize' consecutive rows of the window.
+        Only one chunk is alive at a time, so the memory needed is bounded by
+        the chunk size and not by the size of the window.
+'''
+def iterWindow(file, columns=None, chunksize=None, cache=True):
+    if chunksize is None:
+        yield readWindow(file, columns, cache)
+
+    elif not cache:
+        with pd.read_csv(file, usecols=columns, chunksize=chunksize) as reader:
+            for chunk in reader:
+                yield chunk
+
+    else:
+        rows, data = loadColumns(file, columns, chunksize)
+        for first in range(0, rows, chunksize):
+            yield toFrame(data, first, min(first + chunksize, rows))
+
+
+
+'''
+INPUT:
+    file: path to a csv file
+    columns: list of the columns needed, None for all columns
+    memoryLimit: number of bytes a chunk may use
+
+OUTPUT:
+    chunksize: number of rows per chunk such that a chunk stays below the
+        memory limit. The size of a row is estimated from the first rows of
+        the file. None if there is no limit.
+'''
+def chunkRows(file, columns=None, memoryLimit=None):
+    if memoryLimit is None:
+        return None
+
+    sample = pd.read_csv(file, usecols=columns, nrows=1000)
+    rowSize = sample.memory_usage(index=False, deep=True).sum() / max(len(sample), 1)
+
+    return max(int(memoryLimit // max(rowSize, 1)), 1)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic instances for benchmark.py.
+
+The solvers need a config.json and getConfig.py needs the csv windows in
+'./Berno Daten/dataV2', neither of which is published. makeInstance() writes
+both for a random token graph into a folder:
+
+    <directory>/
+        config.json, config_arrays/     config in the format of getConfig.py
+        Berno Daten/dataV2/
+            poolData.csv                pool / token0 / token1
+            reserves/reservesX-Y.csv    reserves / price / pool / blockNumber / logIndex
+            volumeData/swapsX-Y.csv     tradeVol / tokenIn / tokenOut / blockNumber / logIndex / transactionHash
+
+The instance is described by
+    n: number of tokens
+    density: probability of a pool between two tokens. A random spanning tree
+        is always added, so every token can be reached.
+    reserves: distribution of the reserves of the pools
+        'lognormal': heavy tailed like the Uniswap pools
+        'uniform': between reserveScale/100 and reserveScale
+        'equal': all pools the same
+    demand: distribution of the trades over the pairs
+        'zipf': tokens are used in proportion to 1/rank
+        'uniform': every pair alike
+    buckets: name of a bucket scheme in 'bucketSchemes'
+
+The csv windows are drawn from the same pools and demand, but the reserves
+found in them are jittered, so a config built from them by getConfig.py is
+close to config.json but not the same. Everything is drawn from one seed, so
+an instance is the same on every machine.
+
+"""
+
+import numpy as np
+import pandas as pd
+import pathlib
+import json
+import os
+import itertools
+import binaryConfig
+
+
+
+# (rangeLow, rangeUp, tradesize) of every bucket, rangeUp -1 for no upper end
+bucketSchemes = {
+    'thesis': [(0, 32, 10), (32, 320, 100), (320, 3200, 1000), (3200, 32000, 10000), (32000, -1, 100000)],
+    'coarse': [(0, 320, 30), (320, 32000, 3000), (32000, -1, 100000)],
+    'fine': [(0, 10, 3), (10, 32, 20), (32, 100, 60), (100, 320, 200), (320, 1000, 600), (1000, 3200, 2000),
+             (3200, 10000, 6000), (10000, 32000, 20000), (32000, 100000, 60000), (100000, -1, 300000)]
+}
+
+# Scale of the reserves of a pool, the largest Uniswap pools hold about 3*10^8
+reserveScale = 1e7
+
+# Number of trades counted in config.json
+trades = 1000000
+
+# First block and number of blocks of the csv windows, getConfig.py reads windows of 100000 blocks
+firstBlock = 10100000
+step = 100000
+
+
+
+'''
+INPUT:
+    rng: numpy random generator
+    count: number of addresses
+    length: number of hex digits, 40 for addresses and 64 for hashes
+
+OUTPUT:
+    addresses: list of random lowercase hex strings like the ones in the data
+'''
+def getAddresses(rng, count, length=40):
+    digits = np.array(list('0123456789abcdef'))[rng.integers(0, 16, (count, length))]
+    return ['0x' + ''.join(row) for row in digits]
+
+
+
+'''
+INPUT:
+    scheme: name of the bucket scheme in 'bucketSchemes'
+
+OUTPUT:
+    buckets: buckets dictionary of a pair of tokens without any trades,
+        as in getConfig.newWeights()
+'''
+def getBuckets(scheme):
+    buckets = {}
+    for b, (rangeLow, rangeUp, tradesize) in enumerate(bucketSchemes[scheme]):
+        buckets['bucket' + str(b)] = {
+            'count': 0,
+            'rangeLow': rangeLow,
+            'rangeUp': rangeUp,
+            'tradesize': tradesize
+        }
+
+    return buckets
+
+
+
+'''
+INPUT:
+    n: number of tokens
+    density: probability of a pool between two tokens
+    reserves: distribution of the reserves (see top)
+    demand: distribution of the trades over the pairs (see top)
+    buckets: name of the bucket scheme
+    seed: seed of the random generator
+
+OUTPUT:
+    config: config dictionary in the format of getConfig.py. 'reserves' also
+        has about as many pools to tokens outside of the config as inside,
+        like the data.
+    tokens: dictionary address -> symbol of the tokens, like getConfig.tokenSlice
+'''
+def makeConfig(n, density=1.0, reserves='lognormal', demand='zipf', buckets='thesis', seed=0):
+    rng = np.random.default_rng(seed)
+
+    addresses = getAddresses(rng, 2*n)
+    tokens = {address: 'TKN' + str(i) for i, address in enumerate(addresses[:n])}
+
+    # random spanning tree plus every other pair with probability 'density'
+    order = rng.permutation(n)
+    pairs = {tuple(sorted((order[i], order[rng.integers(i)]))) for i in range(1, n)}
+    for i, j in itertools.combinations(range(n), 2):
+        if rng.random() < density:
+            pairs.add((i, j))
+    pairs = sorted(pairs)
+    pairs += [(rng.integers(n), n + rng.integers(n)) for pool in range(len(pairs))]
+
+    if reserves == 'lognormal':
+        levels = reserveScale * rng.lognormal(0, 1, len(pairs))
+    elif reserves == 'uniform':
+        levels = rng.uniform(reserveScale/100, reserveScale, len(pairs))
+    else:
+        levels = np.full(len(pairs), reserveScale)
+
+    poolAddresses = getAddresses(rng, len(pairs))
+    configReserves = {}
+    for pool, (i, j), level in zip(poolAddresses, pairs, levels):
+        token0, token1 = addresses[i], addresses[j]
+        if rng.random() < 0.5:
+            token0, token1 = token1, token0
+        configReserves[pool] = {
+            'reserves': float(level),
+            'token0': token0,
+            'token1': token1
+        }
+
+    # counts of every (tokenIn, tokenOut, bucket), the middle buckets are the most common
+    popularity = 1/np.arange(1, n+1) if demand == 'zipf' else np.ones(n)
+    popularity = popularity[rng.permutation(n)]
+    scheme = bucketSchemes[buckets]
+    share = np.exp(-((np.arange(len(scheme)) - (len(scheme)-1)/2)/(len(scheme)/3))**2)
+
+    probabilities = popularity[:, None, None] * popularity[None, :, None] * share[None, None, :]
+    probabilities[np.arange(n), np.arange(n), :] = 0
+    counts = rng.multinomial(trades, (probabilities/probabilities.sum()).ravel()).reshape(probabilities.shape)
+
+    weights = {}
+    for i, token1 in enumerate(addresses[:n]):
+        weights[token1] = {'symb': tokens[token1]}
+        for j, token2 in enumerate(addresses[:n]):
+            pairBuckets = getBuckets(buckets)
+            for b, bucket in enumerate(pairBuckets):
+                pairBuckets[bucket]['count'] = int(counts[i, j, b])
+            weights[token1][token2] = {
+                'totalVol': float(sum(counts[i, j, b] * scheme[b][2] for b in range(len(scheme)))),
+                'buckets': pairBuckets
+            }
+
+    config = {
+        'blocks': {
+            'start': firstBlock,
+            'end': firstBlock + step
+        },
+        'size': n,
+        'weights': weights,
+        'reserves': configReserves
+    }
+
+    return config, tokens
+
+
+
+'''
+INPUT:
+    config: config dictionary
+    filename: path of the json file
+
+OUTPUT:
+    writes the config and its binary version as getConfig.py does
+'''
+def writeConfig(config, filename):
+    with open(filename, 'w') as f:
+        json.dump(config, f)
+    binaryConfig.writeBinaryConfig(config, filename)
+
+
+
+'''
+INPUT:
+    directory: folder to write './Berno Daten/dataV2' into
+    config: config dictionary the windows are drawn from
+    windows: number of windows of 'step' blocks
+    swaps: number of swaps per window
+    updates: number of reserve updates per window
+    seed: seed of the random generator
+
+OUTPUT:
+    writes poolData.csv and a swap and a reserve csv for every window, in
+        the folders and with the names getConfig.py reads
+'''
+def writeWindows(directory, config, windows=3, swaps=100000, updates=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    dataPath = pathlib.Path(pathlib.Path(directory)/'Berno Daten'/'dataV2')
+    for folder in ['reserves', 'volumeData']:
+        os.makedirs(pathlib.Path(dataPath/folder), exist_ok=True)
+
+    pools = list(config['reserves'])
+    pd.DataFrame({
+        'pool': pools,
+        'token0': [config['reserves'][pool]['token0'] for pool in pools],
+        'token1': [config['reserves'][pool]['token1'] for pool in pools]
+    }).to_csv(pathlib.Path(dataPath/'poolData.csv'), index=False)
+    levels = np.array([config['reserves'][pool]['reserves'] for pool in pools])
+
+    # trades of every (tokenIn, tokenOut, bucket) in proportion to the counts of the config
+    tokens = list(config['weights'])
+    bucketNames = list(config['weights'][tokens[0]][tokens[0]]['buckets'])
+    cells = list(itertools.product(range(len(tokens)), range(len(tokens)), range(len(bucketNames))))
+    counts = np.array([config['weights'][tokens[i]][tokens[j]]['buckets'][bucketNames[b]]['count'] for i, j, b in cells], dtype=float)
+    ranges = np.array([[config['weights'][tokens[0]][tokens[0]]['buckets'][bucket][key] for key in ['rangeLow', 'rangeUp']] for bucket in bucketNames], dtype=float)
+    ranges[ranges[:, 1] == -1, 1] = 10*np.maximum(ranges[ranges[:, 1] == -1, 0], 1)
+    ranges[:, 0] = np.maximum(ranges[:, 0], 1)
+
+    for w in range(windows):
+        start = firstBlock + w*step
+        name = str(start) + '-' + str(start + 99999) + '.csv'
+
+        cell = rng.choice(len(cells), swaps, p=counts/counts.sum())
+        tokenIn = np.array([cells[c][0] for c in cell])
+        tokenOut = np.array([cells[c][1] for c in cell])
+        bucket = np.array([cells[c][2] for c in cell])
+        low, up = np.log(ranges[bucket, 0]), np.log(ranges[bucket, 1])
+
+        pd.DataFrame({
+            'tradeVol': np.exp(low + (up - low)*rng.random(swaps)),
+            'tokenIn': np.array(tokens)[tokenIn],
+            'tokenOut': np.array(tokens)[tokenOut],
+            'blockNumber': np.sort(rng.integers(start, start + step, swaps)),
+            'logIndex': rng.integers(0, 300, swaps),
+            'transactionHash': getAddresses(rng, swaps, 64)
+        }).to_csv(pathlib.Path(dataPath/'volumeData'/('swaps' + name)), index=False)
+
+        pool = rng.integers(len(pools), size=updates)
+        pd.DataFrame({
+            'reserves': levels[pool] * rng.lognormal(0, 0.1, updates),
+            'price': rng.lognormal(0, 1, updates),
+            'pool': np.array(pools)[pool],
+            'blockNumber': np.sort(rng.integers(start, start + step, updates)),
+            'logIndex': rng.integers(0, 300, updates)
+        }).to_csv(pathlib.Path(dataPath/'reserves'/('reserves' + name)), index=False)
+
+
+
+'''
+INPUT:
+    directory: folder of the instance, created if needed
+    n: number of tokens
+    windows, swaps, updates: size of the csv data (see writeWindows), no csv
+        data if windows is 0
+    options: density, reserves, demand, buckets and seed (see makeConfig)
+
+OUTPUT:
+    tokens: dictionary address -> symbol of the tokens of the instance, the
+        'tokenSlice' to use for getConfig.py
+'''
+def makeInstance(directory, n, windows=3, swaps=100000, updates=20000, **options):
+    os.makedirs(directory, exist_ok=True)
+    config, tokens = makeConfig(n, **options)
+    writeConfig(config, pathlib.Path(pathlib.Path(directory)/'config.json'))
+
+    if windows:
+        writeWindows(directory, config, windows, swaps, updates, options.get('seed', 0))
+
+    return tokens